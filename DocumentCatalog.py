@@ -11,15 +11,84 @@ June 2018
 import os
 import sys
 import argparse
-import pandas as pd
-import platform
 import hashlib
 import datetime
-import xlsxwriter
-import win32com.client
 import sqlite3
+import struct
+import time
+import re
 import random
 import string
+import shutil
+import stat
+import collections
+import itertools
+import json
+import pathlib
+
+class InputError(Exception):
+    pass
+
+
+# PRAGMA user_version of the compact schema. Files are stored in the
+# file_entries table with binary digests and the dir_id of their row
+# in the directories table; the files view presents them with the
+# columns of the original files table. Databases written before the
+# compact schema have user_version 0. Version 3 makes file_key unique
+# per session and stores relative paths with '/'; a version 2
+# database is converted when opened by FileCatalog and can be read
+# as it is.
+SCHEMA_VERSION = 3
+COMPACT_SCHEMA_VERSION = 2
+
+# Oldest SQLite library with every statement the catalog uses
+MIN_SQLITE_VERSION = (3, 33, 0)
+
+
+def rel_path_sql(f='f', d='d'):
+
+    # SQL expression for the relative path of file_entries row f in
+    # directories row d
+
+    return ("CASE WHEN {d}.rel_path = '.' THEN {f}.filename "
+            "ELSE {d}.rel_path || '/' || {f}.filename END").format(f=f, d=d)
+
+
+def to_catalog_path(rel_path):
+
+    # Relative paths are stored with '/' on every platform so that a
+    # catalog joins and compares the same wherever it was written
+
+    return rel_path.replace(os.path.sep, '/') if rel_path is not None else None
+
+
+def from_catalog_path(rel_path):
+
+    # The relative path of a directories row or the files view with
+    # the separator of this platform
+
+    return rel_path.replace('/', os.path.sep) if rel_path is not None else None
+
+
+def hex_to_blob(hex_digest):
+
+    # Digests are hex strings in the program and BLOBs in file_entries
+
+    return bytes.fromhex(hex_digest) if hex_digest else None
+
+
+def schema_version(connection):
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+def read_only_uri(database):
+
+    # SQLite URI that opens an existing database read-only. as_uri
+    # escapes the characters, such as '#' and '?', that would
+    # otherwise end the path.
+
+    return pathlib.Path(os.path.realpath(database)).as_uri() + '?mode=ro'
+
 
 class CatalogProperties(object):
     """CatalogProperties provides an interface for FileCatalog.
@@ -60,10 +129,19 @@ Attributes:
         self.existing_catalog = None
         self.existing_database = None
 
+        # Database read for the checksums of directories unchanged
+        # since an earlier session, if not the catalog database. The
+        # workers of ShardedCatalog write to their own shard but read
+        # the session database.
+        self.previous_database = None
+
         # Session ID is the primary key for the search session that is
         # saved in the database
         self.session_id = None
 
+        # Continue the interrupted scan of session_id
+        self.resume = False
+
         self.database = 'document_catalog.db'
 
         # The number of rows to buffer before inserting into the database
@@ -82,6 +160,33 @@ Attributes:
         self.buffer_size = 65536
 
         self.check_file_contents = True
+
+        # Content-defined chunk index for near-duplicate detection,
+        # off by default because every file has to be read again
+        self.chunk_index = False
+        self.chunk_size = 8192
+
+        # Parse .msg files into the emails table
+        self.emails = False
+
+        # Extract document properties into the file_metadata table
+        self.extract_metadata = False
+
+        # Number of concurrent file system operations for the asyncio
+        # scan of high latency shares, None for the synchronous walk
+        self.concurrency = None
+        self.filesystem = None
+
+        # Number of worker processes, None uses the number of CPUs
+        self.workers = None
+
+        # Scan the top level subdirectories in worker processes, see
+        # ShardedCatalog
+        self.parallel = False
+
+        # Which copy of a duplicated file is the canonical one:
+        # 'shortest' relative path or first in relative 'path' order
+        self.canonical = 'shortest'
         
         self.verbose = False
 
@@ -103,10 +208,13 @@ Attributes:
         else:
             self.base_dir = self.search_dir
 
-        if args.session_id:
+        if args.resume:
+            self.session_id = args.resume
+            self.resume = True
+        elif args.session_id:
             self.session_id = args.session_id
         else:
-            self.session_id = ''.join([random.choice(string.ascii_lowercase) for ii in range(4)])
+            self.new_session_id()
 
         if args.input_file:
             if os.path.isfile(args.input_file):
@@ -117,6 +225,8 @@ Attributes:
                 raise InputError
             
         if args.copy:
+            if not args.copy_dir:
+                raise InputError('A destination directory is needed to copy, use --copy-dir.')
             self.copy = args.copy
             self.copy_dir = args.copy_dir
             self.copy_key = args.copy_key
@@ -139,6 +249,30 @@ Attributes:
 
         if args.do_not_check_file_contents:
             self.check_file_contents = False
+
+        if args.chunk_index or args.near_duplicates is not None:
+            self.chunk_index = True
+
+        if args.chunk_size:
+            self.chunk_size = args.chunk_size
+
+        if args.emails:
+            self.emails = True
+
+        if args.extract_metadata:
+            self.extract_metadata = True
+
+        if args.workers:
+            self.workers = args.workers
+
+        if args.async_concurrency:
+            self.concurrency = args.async_concurrency
+
+        if args.canonical:
+            self.canonical = args.canonical
+
+        if args.parallel:
+            self.parallel = True
             
         if args.verbose:
             self.verbose = True
@@ -148,6 +282,14 @@ Attributes:
         
         pass
 
+    def new_session_id(self):
+
+        # A random session ID. Every row of a catalog belongs to a
+        # session, rows without one could not be told apart.
+
+        self.session_id = ''.join([random.choice(string.ascii_lowercase) for ii in range(4)])
+        return self.session_id
+
     def as_dict(self):
 
         return {'Search Directories': self.search_dirs,
@@ -159,7 +301,31 @@ Attributes:
 
     def insert_to_database(self, cursor):
 
-        cursor.execute('INSERT INTO catalog_properties VALUES (?,?,?,?,?,?)', self.as_tuple())
+        cursor.execute('''
+        INSERT INTO catalog_properties
+        (session_id, search_dir, base_dir, hash_function, hash_buffer_size, date, exclude_dirs)
+        VALUES (?,?,?,?,?,?,?)''', self.as_tuple() + (json.dumps(list(self.exclude_dirs)),))
+
+    def load_from_database(self, cursor):
+        """Restore the search parameters of session_id from the
+        catalog_properties table, used to resume a scan.
+        """
+        cursor.execute('''
+        SELECT search_dir, base_dir, hash_function, hash_buffer_size, exclude_dirs
+        FROM catalog_properties WHERE session_id = ?;
+        ''', (self.session_id,))
+        row = cursor.fetchone()
+
+        if row is None:
+            raise InputError('Session {} not found in {}'.format(self.session_id, self.database))
+
+        self.search_dir, self.base_dir, hash_name, self.buffer_size, exclude_dirs = row
+        self.hash_function = hashlib.new(hash_name)
+
+        # Sessions written before exclude_dirs was stored keep the
+        # command line value
+        if exclude_dirs is not None:
+            self.exclude_dirs = json.loads(exclude_dirs)
 
     def as_tuple(self):
 
@@ -192,6 +358,12 @@ class FileCatalog(object):
         self.catalog_properties = catalog_properties
 
         self.files = []
+        self._file_index = set()
+        self._files_to_database = []
+        self._checkpoints = []
+        self._committed = {}
+        self._dir_ids = {}
+        self.previous_connection = None
         self.load_files()
         self.export()
 
@@ -200,8 +372,17 @@ class FileCatalog(object):
 
     def load_files(self):
 
+        if self.catalog_properties.session_id is None:
+            if self.catalog_properties.resume:
+                raise InputError('A session ID is needed to resume a scan.')
+            self.catalog_properties.new_session_id()
+
         self.create_database()
-        self.catalog_properties.insert_to_database(self.cursor)
+        if self.catalog_properties.resume:
+            self.catalog_properties.load_from_database(self.cursor)
+            self._load_session()
+        else:
+            self.catalog_properties.insert_to_database(self.cursor)
         self.connection.commit()
         print('Session ID: {}'.format(self.catalog_properties.session_id))
 
@@ -222,18 +403,34 @@ class FileCatalog(object):
             print('New Files Loaded: {}'.format(N_new_files))
 
         # Include a final insert_to_database call to add any remaining
-        # files in the buffer
-        if len(self._files_to_database) > 0:
+        # files and checkpoints in the buffer
+        if self._files_to_database or self._checkpoints:
             self.insert_to_database()
-        
+
+        if self.catalog_properties.chunk_index:
+            self.index_chunks()
+
+        if self.catalog_properties.emails:
+            self.catalog_emails()
+
+        if self.catalog_properties.extract_metadata:
+            self.extract_file_metadata()
+
         # Compute duplicates
-        # self.check_duplicates()
+        self.update_duplicates()
 
     def add_file(self, file_obj, existing=False):
-        
-        if file_obj in self.files:
+
+        # Same comparison as File.__eq__ without scanning self.files
+        if self.catalog_properties.check_file_contents:
+            index_key = file_obj.key
+        else:
+            index_key = file_obj.relative_path
+
+        if index_key in self._file_index:
             return
-        
+
+        self._file_index.add(index_key)
         self.files.append(file_obj)
 
         if self.catalog_properties.verbose and not existing:
@@ -249,14 +446,142 @@ class FileCatalog(object):
 
     def insert_to_database(self):
 
-        self.cursor.executemany(
-            'INSERT INTO files VALUES (?,?,?,?,?,?,?,?)',
-            [f.as_tuple() for f in self._files_to_database])
+        self.insert_file_rows([f.as_tuple() for f in self._files_to_database])
+
+        # Every directory in the checkpoint list has all of its files in
+        # this transaction or an earlier one, so it is marked done
+        # together with the rows and its subdirectories join the
+        # frontier
+        session_id = self.catalog_properties.session_id
+        for root, sub_dirs in self._checkpoints:
+            self.cursor.executemany(
+                'INSERT OR IGNORE INTO scan_progress VALUES (?,?,?)',
+                [(session_id, d, 'pending') for d in sub_dirs])
+            self.cursor.execute(
+                'INSERT OR REPLACE INTO scan_progress VALUES (?,?,?)',
+                (session_id, root, 'done'))
 
         self.connection.commit()
 
         # Clear files to database array
         self._files_to_database = []
+        self._checkpoints = []
+
+    def insert_file_rows(self, rows, replace=False):
+        """Insert rows in the File.as_tuple format into file_entries.
+
+        The directory of each relative path is added to the directories
+        table the first time it is seen and the row stores its dir_id.
+        """
+        entries = []
+        for rel_path, name, extension, size, _, checksum, session_id, key in rows:
+            dir_id = self.directory_id(session_id, os.path.dirname(rel_path) or '.')
+            entries.append((dir_id, os.path.basename(rel_path), extension, size,
+                            hex_to_blob(checksum), session_id, hex_to_blob(key)))
+
+        self.cursor.executemany('''
+        INSERT {}INTO file_entries
+        (dir_id, filename, extension, size, checksum, session_id, file_key)
+        VALUES (?,?,?,?,?,?,?);
+        '''.format('OR REPLACE ' if replace else ''), entries)
+
+    def directory_id(self, session_id, rel_path):
+        key = (session_id, to_catalog_path(rel_path))
+        if key not in self._dir_ids:
+            self.cursor.execute(
+                'INSERT OR IGNORE INTO directories (session_id, rel_path) VALUES (?,?)', key)
+            self.cursor.execute(
+                'SELECT dir_id FROM directories WHERE session_id IS ? AND rel_path = ?', key)
+            self._dir_ids[key] = self.cursor.fetchone()[0]
+
+        return self._dir_ids[key]
+
+    def checkpoint(self, root, sub_dirs):
+        """Record that root has been fully searched.
+
+        The checkpoint is written with the next batch of files, or
+        after database_row_buffer directories without files.
+        """
+        self._checkpoints.append((root, sub_dirs))
+
+        if len(self._checkpoints) >= self.catalog_properties.database_row_buffer:
+            self.insert_to_database()
+
+    def scan_frontier(self):
+        """Return the directories that still have to be searched.
+
+        A new scan starts at the search directory. A resumed scan
+        continues from the pending directories of the session; their
+        subtrees have not been visited yet.
+        """
+        session_id = self.catalog_properties.session_id
+        search_dir = os.path.normpath(self.catalog_properties.search_dir)
+
+        if self.catalog_properties.resume:
+            self.cursor.execute('SELECT COUNT(*) FROM scan_progress WHERE session_id = ?',
+                                (session_id,))
+            if self.cursor.fetchone()[0]:
+                self.cursor.execute('''
+                SELECT path FROM scan_progress
+                WHERE session_id = ? AND state = 'pending' ORDER BY path;
+                ''', (session_id,))
+                return [row[0] for row in self.cursor.fetchall()]
+
+        self.cursor.execute('INSERT OR IGNORE INTO scan_progress VALUES (?,?,?)',
+                            (session_id, search_dir, 'pending'))
+        self.connection.commit()
+        return [search_dir]
+
+    def _load_session(self):
+
+        # Load the files already committed by an interrupted scan of
+        # this session so that they are neither hashed nor inserted
+        # again
+
+        self.cursor.execute('''
+        SELECT base_dir, rel_path, filename, extension, size, checksum, file_key
+        FROM files f
+        INNER JOIN catalog_properties cp ON f.session_id = cp.session_id
+        WHERE f.session_id = ?;
+        ''', (self.catalog_properties.session_id,))
+
+        for row in self.cursor.fetchall():
+            row = row[:1] + (from_catalog_path(row[1]),) + row[2:]
+            file_obj = DatabaseFile(row, self.catalog_properties)
+            self._committed[file_obj.relative_path] = file_obj
+            self.add_file(file_obj, existing=True)
+
+        if self.catalog_properties.verbose:
+            print('Resuming with {} files'.format(len(self._committed)))
+
+    def _restore_directories(self):
+
+        # Rebuild the Directory objects of the directories finished
+        # before the scan was resumed so the tree hashes cover the
+        # whole search
+
+        directories = {}
+        if not self.catalog_properties.resume:
+            return directories
+
+        by_directory = {}
+        for file_obj in self._committed.values():
+            path = os.path.normpath(os.path.join(self.catalog_properties.base_dir,
+                                                 os.path.dirname(file_obj.relative_path)))
+            by_directory.setdefault(path, []).append(file_obj)
+
+        self.cursor.execute('''
+        SELECT path FROM scan_progress WHERE session_id = ? AND state = 'done';
+        ''', (self.catalog_properties.session_id,))
+
+        for (path,) in self.cursor.fetchall():
+            files = by_directory.get(path, [])
+            directory = Directory(path, [f.name for f in files], self.catalog_properties)
+            for file_obj in files:
+                directory.add_file(file_obj)
+            directories[path] = directory
+
+        return directories
 
     def _load_existing_catalog(self):
 
@@ -275,12 +600,12 @@ class FileCatalog(object):
     def _load_existing_database(self):
 
         if os.path.isfile(self.catalog_properties.existing_database):
-            existing_conn = sqlite3.connect(self.catalog_properties.existing_database)
+            self.existing_connection = sqlite3.connect(self.catalog_properties.existing_database)
 
         else:
             raise InputError('Error loading existing database, file does not exist.\n{}'.format(self.catalog_properties.existing_database))
 
-        existing_cursor = existing_conn.cursor()
+        existing_cursor = self.existing_connection.cursor()
 
         existing_cursor.execute('''
         SELECT base_dir, rel_path, filename, extension, size, checksum, file_key
@@ -291,6 +616,7 @@ class FileCatalog(object):
         rows = existing_cursor.fetchall()
 
         for row in rows:
+            row = row[:1] + (from_catalog_path(row[1]),) + row[2:]
             file_obj = DatabaseFile(row, self.catalog_properties)
             self.add_file(file_obj, existing=True)
         
@@ -299,6 +625,8 @@ class FileCatalog(object):
 
         existing_filename = self.catalog_properties.existing_catalog
 
+        import pandas as pd
+
         if existing_filename:
             df = pd.read_excel(existing_filename, sheet_name='Catalog')
 
@@ -315,75 +643,776 @@ class FileCatalog(object):
         if self.catalog_properties.verbose:
             print('Searching...')
 
-        for root, dirs, files in os.walk(self.catalog_properties.search_dir):
+        directories = self._restore_directories()
+
+        if self.catalog_properties.concurrency:
+            known = set(os.path.normpath(os.path.join(self.catalog_properties.base_dir, p))
+                        for p in self._committed)
+            scanner = AsyncScanner(self, self.catalog_properties.concurrency,
+                                   filesystem=self.catalog_properties.filesystem,
+                                   known=known)
+            walk = scanner.walk(self.scan_frontier())
+        else:
+            walk = self.walk(self.scan_frontier())
+
+        for root, dirs, files, directory, previous, info in walk:
             if self.catalog_properties.verbose:
                 print(root)
 
+            directories[root] = directory
+
             for f in files:
                 file_path = os.path.join(root, f)
                 try:
-                    file_obj = File(file_path, self.catalog_properties)
+                    if f in info:
+                        file_obj = File(file_path, self.catalog_properties, *info[f])
+                    else:
+                        file_obj = File(file_path, self.catalog_properties)
+                    committed = self._committed.get(file_obj.relative_path)
+                    if committed is not None:
+                        # Already in the database from before the
+                        # scan was interrupted
+                        file_obj = committed
+                    elif f in previous:
+                        file_obj._checksum = previous[f]
                     self.add_file(file_obj)
+                    directory.add_file(file_obj)
 
-                except:
+                except Exception:
                     print('Error loading {}'.format(file_path))
-                    
+
 
             for exclude_dir in self.catalog_properties.exclude_dirs:
                 if exclude_dir in dirs:
                     dirs.remove(exclude_dir)
 
+            # Symlinked directories are not walked, and must not be
+            # resumed from either since os.walk follows a link at the top
+            sub_dirs = [os.path.join(root, d) for d in dirs]
+            self.checkpoint(root, [d for d in sub_dirs if not os.path.islink(d)])
+
+        self.insert_directories(directories)
+
+    def walk(self, tops):
+        """Walk the directories in tops with os.walk.
+
+        Yields tuples (root, dirs, files, directory, previous, info) in
+        the same form as AsyncScanner.walk. Directories removed from
+        dirs are not walked. Each file is stat'ed once, for both the
+        listing hash and the file size in info.
+        """
+        for top in tops:
+            for root, dirs, files in os.walk(top):
+                root = os.path.normpath(root)
+                stats = {}
+                for name in files:
+                    try:
+                        st = os.stat(os.path.join(root, name))
+
+                    except OSError:
+                        continue
+
+                    if stat.S_ISREG(st.st_mode):
+                        stats[name] = (st.st_size, st.st_mtime_ns)
+
+                directory = Directory(root, files, self.catalog_properties, stats)
+                previous = self.find_previous_checksums(directory)
+                info = dict((name, (size,)) for name, (size, mtime) in stats.items())
+                yield root, dirs, files, directory, previous, info
+
+    def find_previous_checksums(self, directory, connection=None):
+        """Return {filename: checksum} for a directory whose listing is
+        unchanged since a previous session, otherwise an empty dict.
+
+        The listing hash covers the names, sizes and modification
+        times of the files in the directory, so a match means the
+        files do not need to be read again. A connection can be given
+        for use from another thread.
+        """
+        if connection is None:
+            connection = (self.previous_connection
+                          or getattr(self, 'existing_connection', self.connection))
+        cursor = connection.cursor()
+
+        compact = schema_version(connection) >= COMPACT_SCHEMA_VERSION
+        rel_path = directory.relative_path
+        if compact:
+            rel_path = to_catalog_path(rel_path)
+
+        cursor.execute('''
+        SELECT d.session_id
+        FROM directories d
+        INNER JOIN catalog_properties cp ON d.session_id = cp.session_id
+        WHERE d.rel_path = ? AND d.listing_hash = ? AND cp.base_dir = ?
+        ORDER BY cp.date DESC LIMIT 1;
+        ''', (rel_path, directory.listing_hash,
+              self.catalog_properties.base_dir))
+
+        row = cursor.fetchone()
+        if row is None:
+            return {}
+
+        # The checksums are read from the session whose listing
+        # matched, since a newer session may have seen other contents
+        session_id = row[0]
+        checksums = {}
+        if compact:
+            cursor.execute('''
+            SELECT f.filename, lower(hex(f.checksum))
+            FROM file_entries f
+            INNER JOIN directories d ON d.dir_id = f.dir_id
+            WHERE d.session_id = ? AND d.rel_path = ? AND f.checksum IS NOT NULL;
+            ''', (session_id, rel_path))
+            names = set(directory.names)
+            for name, checksum in cursor.fetchall():
+                if name in names:
+                    checksums[name] = checksum
+
+            return checksums
+
+        for name in directory.names:
+            cursor.execute('''
+            SELECT f.checksum
+            FROM files f
+            WHERE f.session_id = ? AND f.rel_path = ?;
+            ''', (session_id, os.path.normpath(os.path.join(directory.relative_path, name))))
+            row = cursor.fetchone()
+            if row and row[0]:
+                checksums[name] = row[0]
+
+        return checksums
+
+    def insert_directories(self, directories):
+        """Compute the directory hashes bottom-up and store them in the
+        directories table.
+        """
+        # Deepest directories first so that every child is complete
+        # before its parent is hashed
+        paths = sorted(directories, key=lambda p: p.count(os.path.sep), reverse=True)
+
+        for path in paths:
+            directory = directories[path]
+            parent = directories.get(os.path.dirname(path))
+            if parent is not None and parent is not directory:
+                parent.add_directory(directory)
+
+        # Update rather than replace existing rows so the dir_id of the
+        # file rows stays valid
+        self.cursor.executemany('''
+        INSERT INTO directories
+        (rel_path, parent, name, tree_hash, listing_hash, size, file_count, session_id)
+        VALUES (?,?,?,?,?,?,?,?)
+        ON CONFLICT(session_id, rel_path) DO UPDATE SET
+            parent = excluded.parent, name = excluded.name,
+            tree_hash = excluded.tree_hash, listing_hash = excluded.listing_hash,
+            size = excluded.size, file_count = excluded.file_count;
+        ''', [(to_catalog_path(row[0]), to_catalog_path(row[1])) + row[2:]
+              for row in (directories[p].as_tuple() for p in reversed(paths))])
+
+        self.connection.commit()
+
+    def duplicate_directories(self):
+        """Return the duplicated subtrees of this session.
+
+        Directories are grouped by their tree hash. A group is left
+        out when its copies are the children of the copies of one
+        duplicated parent, so a duplicated project folder is a single
+        group rather than one group per nested directory. A subtree
+        copied into parents that are not copies of each other is
+        still reported.
+
+        Returns:
+            list of tuples (tree_hash, size, file_count, [rel_path, ...])
+            sorted by size, largest first.
+        """
+        self.cursor.execute('''
+        WITH dup AS (
+            SELECT tree_hash FROM directories
+            WHERE session_id IS :session AND file_count > 0
+            GROUP BY tree_hash HAVING COUNT(*) > 1),
+        members AS (
+            SELECT d.tree_hash, d.size, d.file_count, d.rel_path, d.parent,
+                p.tree_hash AS parent_hash
+            FROM directories d
+            INNER JOIN dup ON dup.tree_hash = d.tree_hash
+            LEFT JOIN directories p
+                ON p.session_id IS d.session_id AND p.rel_path = d.parent
+            WHERE d.session_id IS :session),
+        nested AS (
+            SELECT tree_hash FROM members
+            GROUP BY tree_hash
+            HAVING COUNT(parent_hash) = COUNT(*)
+                AND COUNT(DISTINCT parent_hash) = 1
+                AND COUNT(DISTINCT parent) = COUNT(*))
+        SELECT tree_hash, size, file_count, rel_path
+        FROM members
+        WHERE tree_hash NOT IN nested
+        ORDER BY size DESC, tree_hash, rel_path;
+        ''', {'session': self.catalog_properties.session_id})
+
+        groups = {}
+        for tree_hash, size, file_count, rel_path in self.cursor.fetchall():
+            groups.setdefault(tree_hash, (tree_hash, size, file_count, []))[3].append(
+                from_catalog_path(rel_path))
+
+        return [g for g in groups.values() if len(g[3]) > 1]
+
     def create_database(self):
 
-        if os.path.isfile(self.catalog_properties.database):
+        # The oldest SQLite with UPDATE ... FROM, used by
+        # update_duplicates
+        if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+            raise InputError('SQLite {} or later is required, found {}'.format(
+                '.'.join(str(v) for v in MIN_SQLITE_VERSION), sqlite3.sqlite_version))
+
+        if os.path.isfile(self.catalog_properties.database) and not self.catalog_properties.resume:
             usr_response = input('Warning: {} already exists, continue writing to database? [y/N]'.format(self.catalog_properties.database))
             if not usr_response.lower() == 'y':
                 self.catalog_properties.database = input('Please enter new database name: ')
                 self.create_database()
 
-            self.connection = sqlite3.connect(self.catalog_properties.database)
-            self.cursor = self.connection.cursor()
+        self.connection = sqlite3.connect(self.catalog_properties.database)
+        self.cursor = self.connection.cursor()
+        self.create_tables()
 
-        else:
-            self.connection = sqlite3.connect(self.catalog_properties.database)
-            self.cursor = self.connection.cursor()
+        if self.catalog_properties.previous_database:
+            self.previous_connection = sqlite3.connect(
+                read_only_uri(self.catalog_properties.previous_database), uri=True, timeout=60)
+
+    def create_tables(self):
+
+        # A files table rather than the files view is a database
+        # written before the compact schema
+        self.cursor.execute('''
+        SELECT name FROM sqlite_master
+        WHERE type = 'table' AND name IN ('files', 'directories');
+        ''')
+        legacy = [row[0] for row in self.cursor.fetchall()]
+        if 'files' in legacy:
+            self.cursor.execute('BEGIN')
+            for table in legacy:
+                self.cursor.execute('ALTER TABLE {0} RENAME TO legacy_{0}'.format(table))
+            for index in ('files_rel_path', 'files_checksum', 'files_extension',
+                          'directories_tree_hash'):
+                self.cursor.execute('DROP INDEX IF EXISTS {}'.format(index))
+
+        # A compact database of an older version has file_key unique
+        # across sessions, so file_entries is rebuilt with the current
+        # constraint. The files view is dropped with it and recreated
+        # below.
+        self.cursor.execute('''
+        SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'file_entries';
+        ''')
+        rebuild = (self.cursor.fetchone() is not None
+                   and schema_version(self.connection) < SCHEMA_VERSION)
+        if rebuild:
+            self.cursor.execute('BEGIN')
+            self.cursor.execute('DROP VIEW IF EXISTS files')
+            self.cursor.execute('ALTER TABLE file_entries RENAME TO old_file_entries')
+            for index in ('file_entries_dir_id', 'file_entries_checksum',
+                          'file_entries_extension'):
+                self.cursor.execute('DROP INDEX IF EXISTS {}'.format(index))
+
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS file_entries
+        (file_id integer PRIMARY KEY,
+        dir_id integer REFERENCES directories(dir_id),
+        filename text,
+        extension text,
+        size integer,
+        checksum blob,
+        session_id text,
+        file_key blob,
+        duplicate integer,
+        canonical_id integer,
+        UNIQUE(file_key, session_id));
+        ''')
+
+        # Compact databases created before the canonical_id column
+        columns = [row[1] for row in self.cursor.execute('PRAGMA table_info(file_entries)')]
+        if 'canonical_id' not in columns:
+            self.cursor.execute('ALTER TABLE file_entries ADD COLUMN canonical_id integer')
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_properties
+        (session_id text,
+        search_dir text,
+        base_dir text,
+        hash_function text,
+        hash_buffer_size integer,
+        date text,
+        exclude_dirs text,
+        PRIMARY KEY(session_id ASC));
+        ''')
+        columns = [row[1] for row in self.cursor.execute('PRAGMA table_info(catalog_properties)')]
+        if 'exclude_dirs' not in columns:
+            self.cursor.execute('ALTER TABLE catalog_properties ADD COLUMN exclude_dirs text')
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scan_progress
+        (session_id text,
+        path text,
+        state text,
+        PRIMARY KEY(session_id, path));
+        ''')
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS directories
+        (dir_id integer PRIMARY KEY,
+        rel_path text,
+        parent text,
+        name text,
+        tree_hash text,
+        listing_hash text,
+        size integer,
+        file_count integer,
+        session_id text,
+        UNIQUE(session_id, rel_path));
+        ''')
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS directories_tree_hash
+        ON directories(session_id, tree_hash);
+        ''')
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS directories_rel_path
+        ON directories(rel_path);
+        ''')
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS file_entries_dir_id
+        ON file_entries(dir_id, filename);
+        ''')
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS file_entries_checksum
+        ON file_entries(checksum, session_id);
+        ''')
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS file_entries_extension
+        ON file_entries(extension);
+        ''')
+
+        # The original files table, with the relative path, hex digests
+        # and readable size computed at query time. The size is rounded
+        # half to even like get_human_readable.
+        self.cursor.execute('''
+        CREATE VIEW IF NOT EXISTS files AS
+        SELECT rel_path, filename, extension, size,
+            printf('%d%s', whole + (scaled - whole > 0.5
+                                    OR (scaled - whole = 0.5 AND whole % 2 = 1)),
+                   unit) AS human_readable,
+            checksum, session_id, file_key, duplicate
+        FROM (SELECT *, CAST(scaled AS INTEGER) AS whole FROM (
+            SELECT {rel_path} AS rel_path,
+                f.filename,
+                f.extension,
+                f.size,
+                f.size / CASE WHEN f.size > 1099511627776 THEN 1099511627776.0
+                    WHEN f.size > 1073741824 THEN 1073741824.0
+                    WHEN f.size > 1048576 THEN 1048576.0
+                    WHEN f.size > 1024 THEN 1024.0
+                    ELSE 1.0 END AS scaled,
+                CASE WHEN f.size > 1099511627776 THEN 'TB'
+                    WHEN f.size > 1073741824 THEN 'GB'
+                    WHEN f.size > 1048576 THEN 'MB'
+                    WHEN f.size > 1024 THEN 'KB'
+                    ELSE 'B' END AS unit,
+                NULLIF(lower(hex(f.checksum)), '') AS checksum,
+                f.session_id,
+                lower(hex(f.file_key)) AS file_key,
+                f.duplicate
+            FROM file_entries f
+            INNER JOIN directories d ON d.dir_id = f.dir_id));
+        '''.format(rel_path=rel_path_sql()))
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chunk_files
+        (checksum text,
+        size integer,
+        chunk_count integer,
+        PRIMARY KEY(checksum));
+        ''')
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chunks
+        (checksum text,
+        offset integer,
+        length integer,
+        chunk_hash text,
+        PRIMARY KEY(checksum, offset));
+        ''')
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS chunks_chunk_hash
+        ON chunks(chunk_hash, checksum);
+        ''')
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS file_metadata
+        (checksum text,
+        title text,
+        author text,
+        last_modified_by text,
+        created text,
+        modified text,
+        pages integer,
+        sheets integer,
+        error integer,
+        PRIMARY KEY(checksum));
+        ''')
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS emails
+        (checksum text,
+        subject text,
+        sender text,
+        recipients text,
+        cc text,
+        sent_date text,
+        attachments integer,
+        error integer,
+        PRIMARY KEY(checksum));
+        ''')
+
+        if rebuild:
+            self.migrate_file_entries()
+        if 'files' in legacy:
+            self.migrate_legacy_tables('directories' in legacy)
+
+        self.cursor.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        self.connection.commit()
+
+        if 'files' in legacy or rebuild:
+            # Release the space of the dropped tables
+            self.cursor.execute('VACUUM')
+
+    def migrate_file_entries(self):
+        """Copy the rows of the file_entries table of an older compact
+        database into the rebuilt table, then drop the old table.
+        Relative paths written with another separator are converted to
+        '/'.
+        """
+        columns = [row[1] for row in self.cursor.execute('PRAGMA table_info(old_file_entries)')]
+        self.cursor.execute('''
+        INSERT INTO file_entries ({0})
+        SELECT {0} FROM old_file_entries;
+        '''.format(', '.join(columns)))
+        self.cursor.execute('DROP TABLE old_file_entries')
+
+        if os.path.sep != '/':
+            self.connection.create_function(
+                'catalog_path', 1, to_catalog_path, deterministic=True)
             self.cursor.execute('''
-            CREATE TABLE files
-            (rel_path text,
-            filename text,
-            extension text,
-            size integer,
-            human_readable text,
-            checksum text,
-            session_id text,
-            file_key text,
-            PRIMARY KEY(file_key));
+            UPDATE directories
+            SET rel_path = catalog_path(rel_path), parent = catalog_path(parent);
             ''')
+
+    def migrate_legacy_tables(self, directories=True):
+        """Copy the rows of the files and directories tables of a
+        database written before the compact schema into file_entries
+        and directories, then drop the old tables.
+        """
+        self.connection.create_function(
+            'catalog_dirname', 1, lambda p: to_catalog_path(os.path.dirname(p)) or '.',
+            deterministic=True)
+        self.connection.create_function(
+            'catalog_basename', 1, os.path.basename, deterministic=True)
+        self.connection.create_function(
+            'catalog_path', 1, to_catalog_path, deterministic=True)
+        self.connection.create_function(
+            'catalog_digest', 1, hex_to_blob, deterministic=True)
+
+        if directories:
             self.cursor.execute('''
-            CREATE TABLE catalog_properties
-            (session_id text,
-            search_dir text,
-            base_dir text,
-            hash_function text,
-            hash_buffer_size integer,
-            date text,
-            PRIMARY KEY(session_id ASC));
+            INSERT INTO directories
+            (rel_path, parent, name, tree_hash, listing_hash, size, file_count, session_id)
+            SELECT catalog_path(rel_path), catalog_path(parent), name, tree_hash,
+                listing_hash, size, file_count, session_id
+            FROM legacy_directories;
             ''')
-            
-            self.connection.commit()
+            self.cursor.execute('DROP TABLE legacy_directories')
+
+        # Databases created before the duplicate column was added
+        columns = [row[1] for row in self.cursor.execute('PRAGMA table_info(legacy_files)')]
+        duplicate = 'f.duplicate' if 'duplicate' in columns else 'NULL'
+
+        # Rows without a session ID are matched with IS, and their
+        # directories are created once since the UNIQUE constraint does
+        # not apply to NULL
+        self.cursor.execute('''
+        INSERT INTO directories (session_id, rel_path)
+        SELECT DISTINCT f.session_id, catalog_dirname(f.rel_path) FROM legacy_files f
+        WHERE NOT EXISTS (
+            SELECT 1 FROM directories d
+            WHERE d.session_id IS f.session_id AND d.rel_path = catalog_dirname(f.rel_path));
+        ''')
+        self.cursor.execute('SELECT COUNT(*) FROM legacy_files')
+        legacy_count = self.cursor.fetchone()[0]
+        self.cursor.execute('SELECT COUNT(*) FROM file_entries')
+        before = self.cursor.fetchone()[0]
+        self.cursor.execute('''
+        INSERT INTO file_entries
+        (dir_id, filename, extension, size, checksum, session_id, file_key, duplicate)
+        SELECT (SELECT MIN(d.dir_id) FROM directories d
+                WHERE d.session_id IS f.session_id AND d.rel_path = catalog_dirname(f.rel_path)),
+            catalog_basename(f.rel_path), f.extension, f.size,
+            catalog_digest(f.checksum), f.session_id, catalog_digest(f.file_key), {}
+        FROM legacy_files f;
+        '''.format(duplicate))
+        self.cursor.execute('SELECT COUNT(*) FROM file_entries')
+        count = self.cursor.fetchone()[0] - before
+        if count != legacy_count:
+            # Keep the original tables rather than lose rows
+            self.connection.rollback()
+            raise InputError('Converted {} of {} files of {}, the database was not changed.'.format(
+                count, legacy_count, self.catalog_properties.database))
+        self.cursor.execute('DROP TABLE legacy_files')
 
+        if self.catalog_properties.verbose:
+            print('Converted {} to the compact schema'.format(self.catalog_properties.database))
+
+    def index_chunks(self):
+        """Split the files of the catalog into content-defined chunks
+        and store the chunk hashes in the chunks table.
 
-    def check_duplicates(self):
-        hash_map = {}
+        Each unique checksum is chunked once, including across
+        sessions, and the files are read in parallel by a pool of
+        worker processes.
+        """
+        import multiprocessing
 
+        indexed = set(row[0] for row in
+                      self.cursor.execute('SELECT checksum FROM chunk_files'))
+
+        jobs = {}
         for file_obj in self.files:
-            if file_obj.checksum in hash_map:
-                file_obj.duplicate = True
+            checksum = file_obj.checksum
+            if checksum and checksum not in indexed and checksum not in jobs:
+                jobs[checksum] = (checksum, file_obj.path,
+                                  self.catalog_properties.hash_function.name,
+                                  self.catalog_properties.buffer_size,
+                                  self.catalog_properties.chunk_size)
 
-            else:
-                file_obj.duplicate = False
-                hash_map[file_obj.checksum] = True
-                
+        if self.catalog_properties.verbose:
+            print('Chunking {} files...'.format(len(jobs)))
+
+        if not jobs:
+            return
+
+        with multiprocessing.Pool(self.catalog_properties.workers) as pool:
+            results = pool.imap_unordered(_chunk_file_worker, jobs.values())
+            for ii, (checksum, chunks) in enumerate(results):
+                if chunks is None:
+                    print('Error chunking {}'.format(jobs[checksum][1]))
+                    continue
+
+                self.cursor.executemany(
+                    'INSERT OR REPLACE INTO chunks VALUES (?,?,?,?)',
+                    [(checksum,) + c for c in chunks])
+                self.cursor.execute(
+                    'INSERT OR REPLACE INTO chunk_files VALUES (?,?,?)',
+                    (checksum, sum(c[1] for c in chunks), len(chunks)))
+
+                if ii % self.catalog_properties.database_row_buffer == 0:
+                    self.connection.commit()
+
+        self.connection.commit()
+
+    def catalog_emails(self):
+        """Parse the .msg files of the catalog into the emails table.
+
+        Results are cached by checksum, so an email that is already in
+        the emails table, from this or any earlier session, is not
+        parsed again. The remaining files are parsed by a pool of
+        worker processes.
+        """
+        import multiprocessing
+
+        cached = set(row[0] for row in
+                     self.cursor.execute('SELECT checksum FROM emails'))
+
+        jobs = {}
+        for file_obj in self.files:
+            checksum = file_obj.checksum
+            if (file_obj.extension.lower() == '.msg' and checksum
+                    and checksum not in cached):
+                jobs[checksum] = file_obj.path
+
+        if self.catalog_properties.verbose:
+            print('Parsing {} emails...'.format(len(jobs)))
+
+        if not jobs:
+            return
+
+        with multiprocessing.Pool(self.catalog_properties.workers) as pool:
+            results = pool.imap(parse_msg_file, jobs.values())
+            for checksum, d in zip(jobs, results):
+                sent_date = d.get('Sent Date')
+                self.cursor.execute(
+                    'INSERT OR REPLACE INTO emails VALUES (?,?,?,?,?,?,?,?)',
+                    (checksum, d.get('Subject'), d.get('From'), d.get('To'),
+                     d.get('CC'), sent_date.isoformat() if sent_date else None,
+                     d.get('Number of Attachments'), d['error']))
+
+        self.connection.commit()
+
+    def extract_file_metadata(self):
+        """Extract document properties into the file_metadata table.
+
+        Every file whose extension has an extractor registered in
+        METADATA_EXTRACTORS is passed to it by a pool of worker
+        processes. Results are cached by checksum, so a file whose
+        checksum already has a row in file_metadata is skipped unless
+        that row recorded an error.
+        """
+        import multiprocessing
+
+        # Rows recorded with an error are extracted again
+        cached = set(row[0] for row in
+                     self.cursor.execute('SELECT checksum FROM file_metadata WHERE error = 0'))
+
+        jobs = {}
+        for file_obj in self.files:
+            checksum = file_obj.checksum
+            if (file_obj.extension.lower() in METADATA_EXTRACTORS and checksum
+                    and checksum not in cached):
+                jobs[checksum] = file_obj.path
+
+        if self.catalog_properties.verbose:
+            print('Extracting metadata from {} files...'.format(len(jobs)))
+
+        if not jobs:
+            return
+
+        columns = ('title', 'author', 'last_modified_by', 'created',
+                   'modified', 'pages', 'sheets')
+
+        with multiprocessing.Pool(self.catalog_properties.workers) as pool:
+            results = pool.imap(extract_metadata_for_file, jobs.values(),
+                                chunksize=self.catalog_properties.database_row_buffer // 10 or 1)
+            for ii, (checksum, d) in enumerate(zip(jobs, results)):
+                self.cursor.execute(
+                    'INSERT OR REPLACE INTO file_metadata VALUES (?,?,?,?,?,?,?,?,?)',
+                    (checksum,) + tuple(d.get(c) for c in columns) + (d['error'],))
+
+                if ii % self.catalog_properties.database_row_buffer == 0:
+                    self.connection.commit()
+
+        self.connection.commit()
+
+    def _session_chunks(self):
+
+        # Collect the distinct chunks of the files of this session in a
+        # temporary table, with the number of files sharing each chunk
+
+        self.cursor.execute('DROP TABLE IF EXISTS temp.session_chunks;')
+        self.cursor.execute('''
+        CREATE TEMP TABLE session_chunks AS
+        WITH s AS (SELECT DISTINCT lower(hex(checksum)) AS checksum FROM file_entries
+                   WHERE session_id IS ? AND checksum IS NOT NULL),
+        u AS (SELECT DISTINCT c.checksum, c.chunk_hash, c.length FROM chunks c
+              INNER JOIN s ON s.checksum = c.checksum)
+        SELECT checksum, chunk_hash, length,
+            COUNT(*) OVER (PARTITION BY chunk_hash) AS sharing
+        FROM u;
+        ''', (self.catalog_properties.session_id,))
+        self.cursor.execute('CREATE INDEX temp.session_chunks_chunk_hash ON session_chunks(chunk_hash, checksum);')
+
+    def shared_byte_ratios(self):
+        """Return the fraction of each file's bytes found in other files
+        of this session.
+
+        Returns:
+            list of tuples (checksum, size, shared_bytes, ratio) for the
+            chunked files that share at least one chunk with another
+            file, highest ratio first.
+        """
+        self._session_chunks()
+        self.cursor.execute('''
+        SELECT cf.checksum, cf.size, SUM(c.length),
+            CAST(SUM(c.length) AS REAL) / cf.size AS ratio
+        FROM chunks c
+        INNER JOIN chunk_files cf ON cf.checksum = c.checksum
+        INNER JOIN session_chunks s ON s.checksum = c.checksum AND s.chunk_hash = c.chunk_hash
+        WHERE s.sharing > 1
+        GROUP BY cf.checksum
+        ORDER BY ratio DESC, cf.size DESC;
+        ''')
+
+        return self.cursor.fetchall()
+
+    def near_duplicates(self, min_ratio=0.5, max_sharing=100):
+        """Return the pairs of files of this session that share content.
+
+        The ratio is the number of distinct shared bytes divided by the
+        size of the larger file of the pair, so two versions of a
+        document that differ by a few bytes have a ratio close to 1.
+        Exact duplicates have the same checksum and are not reported.
+
+        Chunks found in more than max_sharing files, such as runs of
+        zeros or common headers, are left out of the comparison: every
+        pair of files sharing a chunk is joined, so one popular chunk
+        costs the square of its count.
+
+        Args:
+            min_ratio (float): Only return pairs at or above this ratio.
+            max_sharing (int): Ignore chunks shared by more files.
+
+        Returns:
+            list of tuples (checksum_a, checksum_b, shared_bytes, ratio)
+            highest ratio first.
+        """
+        self._session_chunks()
+        self.cursor.execute('''
+        WITH u AS (SELECT checksum, chunk_hash, length FROM session_chunks
+                   WHERE sharing BETWEEN 2 AND ?)
+        SELECT a.checksum, b.checksum, SUM(a.length) AS shared,
+            CAST(SUM(a.length) AS REAL) / MAX(fa.size, fb.size) AS ratio
+        FROM u a
+        INNER JOIN u b ON a.chunk_hash = b.chunk_hash AND a.checksum < b.checksum
+        INNER JOIN chunk_files fa ON fa.checksum = a.checksum
+        INNER JOIN chunk_files fb ON fb.checksum = b.checksum
+        GROUP BY a.checksum, b.checksum
+        HAVING ratio >= ?
+        ORDER BY ratio DESC, shared DESC;
+        ''', (max_sharing, min_ratio))
+
+        return self.cursor.fetchall()
+
+    def update_duplicates(self, checksums=None):
+        """Mark the duplicate files of this session in the database.
+
+        The files with the same checksum are ranked by SQLite and the
+        first is the canonical copy: the shortest relative path, or
+        the first in relative path order if catalog_properties.canonical
+        is 'path'. Every file stores the file_id of its canonical copy
+        in canonical_id and all but the canonical copy are marked as
+        duplicates. The ranking is a single sort inside SQLite, which
+        spills to temporary files, so memory stays flat however large
+        the catalog is. UPDATE ... FROM needs SQLite 3.33 or later,
+        which create_database checks.
+
+        Args:
+            checksums (iterable of str): Only update the files with
+                these checksums. If None, all files are updated.
+        """
+        rel_path = rel_path_sql()
+        order = {'shortest': 'length({0}), {0}'.format(rel_path),
+                 'path': rel_path}[self.catalog_properties.canonical]
+
+        update = '''
+        WITH ranked AS (
+            SELECT f.file_id, first_value(f.file_id) OVER (
+                PARTITION BY f.checksum ORDER BY {}) AS canonical_id
+            FROM file_entries f
+            INNER JOIN directories d ON d.dir_id = f.dir_id
+            WHERE f.session_id IS ? AND f.checksum {})
+        UPDATE file_entries
+        SET canonical_id = ranked.canonical_id,
+            duplicate = file_entries.file_id != ranked.canonical_id
+        FROM ranked
+        WHERE file_entries.file_id = ranked.file_id;
+        '''
+        session_id = self.catalog_properties.session_id
+
+        if checksums is None:
+            self.cursor.execute(update.format(order, 'IS NOT NULL'), (session_id,))
+
+        else:
+            self.cursor.executemany(update.format(order, '= ?'),
+                                    [(session_id, hex_to_blob(c)) for c in set(checksums) if c])
+
+        self.connection.commit()
 
     def export(self):
         if self.catalog_properties.output_file:
@@ -405,6 +1434,8 @@ class FileCatalog(object):
 
     def to_excel(self):
 
+        import pandas as pd
+
         writer = pd.ExcelWriter(self.catalog_properties.output_file,
                                 engine='xlsxwriter')
         
@@ -417,7 +1448,7 @@ class FileCatalog(object):
         workbook = writer.book
         self.properties_to_excel(workbook)
 
-        writer.save()
+        writer.close()
 
 
     def properties_to_excel(self, workbook):
@@ -462,6 +1493,19 @@ class FileCatalog(object):
 
     def as_df(self):
 
+        import pandas as pd
+
+        # Duplicate flags set in the database by update_duplicates. The
+        # same file has the same key in every session, so only the
+        # flags of this session apply.
+        self.cursor.execute('''
+        SELECT lower(hex(file_key)), duplicate FROM file_entries
+        WHERE duplicate IS NOT NULL AND session_id IS ?;
+        ''', (self.catalog_properties.session_id,))
+        duplicates = dict(self.cursor.fetchall())
+        for file_obj in self.files:
+            file_obj.duplicate = bool(duplicates.get(file_obj.key, file_obj.duplicate))
+
         files = [f.as_dict() for f in self.files]
 
         df = pd.DataFrame(files)
@@ -513,6 +1557,8 @@ class File(object):
     Args:
         path (str): A path to the file. If the file does not exist,
             an InputError is thrown.
+        size (int): The file size if already known.
+        checksum (str): The checksum if already known.
 
     Attributes:
         path (str): A file path to the file in question.
@@ -528,10 +1574,11 @@ class File(object):
 
     """
 
-    def __init__(self, path, catalog_properties):
+    def __init__(self, path, catalog_properties, size=None, checksum=None):
 
-        # Check path exists
-        if not os.path.isfile(path):
+        # Check path exists, unless the size is already known from a
+        # directory scan
+        if size is None and not os.path.isfile(path):
             raise InputError
 
         # Assign constructor input parameters
@@ -543,8 +1590,8 @@ class File(object):
         self.extension = self.find_extension()
 
         self._relative_path = None
-        self._size = None
-        self._checksum = None
+        self._size = size
+        self._checksum = checksum
         self._key = None
         self.duplicate = False
 
@@ -569,7 +1616,7 @@ class File(object):
                      'Duplicate': self.duplicate}
         
         if base_dir:
-            sub_dirs = self.find_sub_dirs(base_dir)
+            sub_dirs = self.find_sub_dirs()
 
         else:
             return file_dict
@@ -614,14 +1661,14 @@ class File(object):
 
     @property
     def checksum(self):
-        if not self._checksum:
+        if self._checksum is None:
             self._checksum = self.find_checksum()
 
         return self._checksum
 
     @property
     def size(self):
-        if not self._size:
+        if self._size is None:
             self._size = self.find_file_size()
 
         return self._size
@@ -675,159 +1722,2426 @@ class DatabaseFile(File):
         self.catalog_properties = catalog_properties
 
 
-def copy_files(source_dir, dest_dir, batch_file = 'run_DC_copy.bat', allow_dest_exist=False):
-
-    """
-    copy_files(source_dir, dest_dir)
+class Directory(object):
+    """Directory aggregates the contents of a directory.
 
-    Use the following windows commands to copy the files and change
-    the attributes. Create a batch file and run using Windows
-    command.
+    Directory collects the files and subdirectories found during the
+    walk and computes a Merkle-style tree hash over them, so that two
+    directories with identical contents have the same tree hash no
+    matter where they are located or what they are called.
 
-    robocopy source_dir dest_dir *.* /E /COPY:DT /DCOPY:DAT
-    attrib +R dest_dir\* /S
-    """
+    Args:
+        path (str): A path to the directory.
+        names (list of str): The filenames contained directly in the
+            directory, as returned by os.walk.
+        stats (dict): Filename to (size, mtime) if the files have
+            already been stat'ed, otherwise they are stat'ed here.
 
-    if not platform.system() == 'Windows':
-        raise OSError
+    Attributes:
+        path (str): A path to the directory.
+        name (str): The directory name.
+        relative_path (str): The path relative to the base directory.
+        parent (str): The relative path of the parent directory, None
+            for the top of the search.
+        listing_hash (str): A hash of the names, sizes and modification
+            times of the files in the directory, used to skip hashing
+            unchanged directories on a rescan.
+        size (int): The total size in bytes of the subtree.
+        file_count (int): The number of files in the subtree.
 
-    if not allow_dest_exist:
-        if os.path.isdir(dest_dir):
-            # Destination directory already exists
-            print('''Destination directory exists. Rerun 
-                     with --allow-overwrite flag to enable 
-                     copying. Warning, this may cause overwriting 
-                     of existing files.''')
-            
-            return -1
+    """
 
-        else:
-            os.mkdir(dest_dir)
+    def __init__(self, path, names, catalog_properties, stats=None):
 
+        self.path = path
+        self.names = list(names)
+        self._stats = stats
+        self.catalog_properties = catalog_properties
 
-    with open(batch_file, 'w') as bfile:
+        self.name = os.path.split(os.path.normpath(path))[1]
+        self.relative_path = os.path.relpath(path, catalog_properties.base_dir)
+        self.parent = None
 
-        bfile.write('ECHO OFF\n')
-        bfile.write('ROBOCOPY "{}" "{}" *.* /E /COPY:DT /DCOPY:DAT\n'.format(source_dir, dest_dir))
-        bfile.write('ATTRIB +R "{}"\\* /S'.format(dest_dir))
+        self.files = []
+        self.children = []
+        self.size = 0
+        self.file_count = 0
 
-    try:
-        os.system(batch_file)
+        self.listing_hash = self.find_listing_hash()
+        self._tree_hash = None
+        self._stats = None
 
-    except:
-        print('Batch file did not run correctly.')
-        return -2
+    def __str__(self):
+        return self.relative_path
 
-    finally:
-        os.remove(batch_file)
+    def add_file(self, file_obj):
+        self.files.append((file_obj.name, file_obj.checksum or ''))
+        self.size += file_obj.size
+        self.file_count += 1
 
-    return 1
+    def add_directory(self, directory):
+        directory.parent = self.relative_path
+        self.children.append(directory)
+        self.size += directory.size
+        self.file_count += directory.file_count
 
+    def as_tuple(self):
+        return (self.relative_path, self.parent, self.name, self.tree_hash,
+                self.listing_hash, self.size, self.file_count,
+                self.catalog_properties.session_id)
 
-def compute_checksum_for_file(file_path, hash_function, buffer_size):
+    @property
+    def tree_hash(self):
+        if not self._tree_hash:
+            self._tree_hash = self.find_tree_hash()
 
-    h = hashlib.new(hash_function.name)
+        return self._tree_hash
 
-    try:
-        with open(file_path, 'rb') as f:
-            data = f.read(buffer_size)
-            while data:
-                h.update(data)
-                data = f.read(buffer_size)
+    def find_tree_hash(self):
+        entries = [('f', name, checksum) for name, checksum in self.files]
+        entries += [('d', d.name, d.tree_hash) for d in self.children]
 
+        h = hashlib.new(self.catalog_properties.hash_function.name)
+        for entry in sorted(entries):
+            h.update('{}\0{}\0{}\n'.format(*entry).encode())
         return h.hexdigest()
 
-    except PermissionError:
-        return None
-
-    return None
-    
-def long_file_name(fname):
+    def find_listing_hash(self):
+        h = hashlib.new(hashlib.sha1().name)
+        for name in sorted(self.names):
+            try:
+                if self._stats is not None:
+                    size, mtime = self._stats[name]
+                else:
+                    st = os.stat(os.path.join(self.path, name))
+                    size, mtime = st.st_size, st.st_mtime_ns
+                h.update('{}\0{}\0{}\n'.format(name, size, mtime).encode())
 
-    # Create the Windows long file name representation for local and
-    # network locations.
+            except (OSError, KeyError):
+                h.update('{}\n'.format(name).encode())
 
-    if(fname.lower().startswith('c:')):
+        return h.hexdigest()
 
-        long_name = r'\\?\{}'.format(os.path.normpath(fname))
 
-    elif(fname.startswith(r'\\')):
+class LocalFileSystem(object):
+    """LocalFileSystem provides the blocking file system calls used by
+    AsyncScanner.
 
-        long_name = r'\\?\UNC{}'.format(fname[1:])
+    Each method is run in a worker thread by AsyncScanner. Subclass to
+    change how the file system is accessed.
 
-    return long_name
+    """
 
+    def listdir(self, path):
+        """Return (filenames, directory names, symlinked directory names)."""
+        files, dirs, links = [], [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        (links if entry.is_symlink() else dirs).append(entry.name)
+                    else:
+                        files.append(entry.name)
 
-def get_human_readable(size, precision=0):
+                except OSError:
+                    files.append(entry.name)
 
-    # Take bytes as input and return human readable string to
-    # specified precision.
+        return files, dirs, links
 
-    suffixes = ['B', 'KB', 'MB', 'GB', 'TB']
-    suffixIndex = 0
+    def stat(self, path):
+        """Return (size, mtime) of a regular file."""
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            raise InputError('Not a file: {}'.format(path))
+        return st.st_size, st.st_mtime_ns
 
-    while size > 1024 and suffixIndex < 4:
-        suffixIndex += 1  # increment the index of the suffix
-        size = size/1024.0  # apply the division
+    def checksum(self, path, hash_name, buffer_size):
+        return compute_checksum_for_file(path, hashlib.new(hash_name), buffer_size)
 
-    return "%.*f%s"%(int(precision), size, suffixes[suffixIndex])
 
+class LatencyFileSystem(LocalFileSystem):
+    """LatencyFileSystem adds a fixed delay to every call.
 
-def email_catalog(emails):
+    Used to simulate a high latency network share on a local disk,
+    for testing and benchmarking AsyncScanner.
 
+    Args:
+        latency (float): Seconds to sleep before every call.
 
-    # Create Outlook object using MAPI
-    outlook = win32com.client.Dispatch("Outlook.Application").GetNamespace("MAPI")
+    Attributes:
+        in_flight (int): The number of calls currently sleeping.
+        max_in_flight (int): The most calls that were in flight at
+            the same time.
 
-    # Initialize data structure as an empty list. Entries will
-    # be dictionaries including the appropriate data for each
-    # email.
-    catalog = []
+    """
 
-    for e in emails:
+    def __init__(self, latency=0.01):
+        import threading
 
-        d = {'Filename': e['Filename'],
-             'Link Path': e['Link Path'],
-             'Directory': e['Directory'],
-             'File Size': e['File Size'],
-             'File Path': e['File Path'],
-             'File Link': e['File Link'],
-             'Directory Link': e['Directory Link']}
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
 
-        d['error'] = 0
+    def _wait(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
 
         try:
+            time.sleep(self.latency)
 
-            msg = outlook.OpenSharedItem(d['Link Path'])
+        finally:
+            with self._lock:
+                self.in_flight -= 1
 
-            try:
-                d['Subject'] = msg.Subject
+    def listdir(self, path):
+        self._wait()
+        return super().listdir(path)
 
-                try:
-                    d['From']    = msg.SenderName
-                    d['To']      = msg.To
-                    d['CC']      = msg.CC
+    def stat(self, path):
+        self._wait()
+        return super().stat(path)
 
-                except:
-                    d['error'] += 4
+    def checksum(self, path, hash_name, buffer_size):
+        self._wait()
+        return super().checksum(path, hash_name, buffer_size)
 
-                d['Number of Attachments']  = int(msg.Attachments.Count)
 
-                t = msg.SentOn
-                d['Sent Date'] = datetime.datetime(t.year,t.month,t.day,t.hour,t.minute,t.second)
+class AsyncScanner(object):
+    """AsyncScanner walks a tree with many file system calls in flight.
 
-            except:
-                d['error'] += 2
+    On a high latency network share every directory listing, stat and
+    read waits on a round trip. AsyncScanner runs an asyncio event loop
+    in a background thread that lists directories, stats files and
+    hashes them concurrently, and hands finished directories to the
+    FileCatalog thread through a bounded queue. The results are the
+    same as FileCatalog.walk, so the rest of the scan is unchanged.
 
-        except:
-            d['error'] += 1
+    Args:
+        file_catalog (:FileCatalog:): The catalog being built.
+        concurrency (int): The number of file system calls in flight.
+        filesystem (:LocalFileSystem:): The file system to scan.
+        known (set of str): Normalized paths of files that must not be
+            hashed because they are already in the database.
+        queue_size (int): The number of finished directories buffered
+            for the FileCatalog thread.
 
-        else:
-            del(msg)
+    """
+
+    _done = object()
+
+    def __init__(self, file_catalog, concurrency=32, filesystem=None,
+                 known=None, queue_size=64):
+
+        self.file_catalog = file_catalog
+        self.catalog_properties = file_catalog.catalog_properties
+        self.concurrency = concurrency
+        self.filesystem = filesystem or LocalFileSystem()
+        self.known = known or set()
+        self.queue_size = queue_size
+        self._stopped = False
+
+    def walk(self, tops):
+        """Yield (root, dirs, files, directory, previous, info) for every
+        directory under tops, where info maps filename to (size,
+        checksum). Directories are yielded parents first but otherwise
+        in completion order.
+        """
+        import queue
+        import threading
+        import asyncio
+
+        results = queue.Queue(self.queue_size)
+        thread = threading.Thread(
+            target=lambda: asyncio.run(self._run(list(tops), results)), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = results.get()
+                if item is self._done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+
+        finally:
+            # Unblock the scanner if the consumer stops early
+            self._stopped = True
+            while thread.is_alive():
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    async def _run(self, tops, results):
+        import asyncio
+        import concurrent.futures
+
+        loop = asyncio.get_running_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.concurrency)
+        self._results = results
+
+        # The database lookups block, so they run on a thread of their
+        # own that owns the connection and serializes its use
+        database = (self.catalog_properties.previous_database
+                    or self.catalog_properties.existing_database
+                    or self.catalog_properties.database)
+        self._database_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._connection = await loop.run_in_executor(
+            self._database_executor, lambda: sqlite3.connect(database, timeout=60))
+
+        try:
+            await asyncio.gather(*(self._scan_directory(os.path.normpath(top)) for top in tops))
+            item = self._done
+
+        except BaseException as e:
+            item = e
+
+        finally:
+            await loop.run_in_executor(self._database_executor, self._connection.close)
+            self._database_executor.shutdown(wait=False)
+            self._executor.shutdown(wait=False)
+
+        await loop.run_in_executor(None, results.put, item)
+
+    async def _call(self, function, *args):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, function, *args)
+        except (OSError, InputError):
+            return None
+
+    async def _scan_directory(self, root):
+        import asyncio
+
+        if self._stopped:
+            return
+
+        listing = await self._call(self.filesystem.listdir, root)
+        if listing is None:
+            print('Error listing {}'.format(root))
+            return
+
+        files, dirs, links = listing
+        exclude_dirs = self.catalog_properties.exclude_dirs
+        dirs = [d for d in dirs if d not in exclude_dirs]
+        links = [d for d in links if d not in exclude_dirs]
+
+        paths = [os.path.join(root, f) for f in files]
+        file_stats = await asyncio.gather(*(self._call(self.filesystem.stat, p) for p in paths))
+        stats = dict((f, st) for f, st in zip(files, file_stats) if st is not None)
+        files = [f for f in files if f in stats]
+
+        directory = Directory(root, files, self.catalog_properties, stats=stats)
+        loop = asyncio.get_running_loop()
+        previous = await loop.run_in_executor(
+            self._database_executor, self.file_catalog.find_previous_checksums,
+            directory, self._connection)
+
+        to_hash = [f for f in files if f not in previous
+                   and os.path.join(root, f) not in self.known]
+        checksums = await asyncio.gather(*(
+            self._call(self.filesystem.checksum, os.path.join(root, f),
+                       self.catalog_properties.hash_function.name,
+                       self.catalog_properties.buffer_size) for f in to_hash))
+        checksums = dict(zip(to_hash, checksums))
+
+        info = dict((f, (stats[f][0], checksums.get(f))) for f in files)
+
+        # Symlinked directories are listed like os.walk does but are
+        # not followed
+        item = (root, dirs + links, files, directory, previous, info)
+        await loop.run_in_executor(None, self._results.put, item)
+
+        await asyncio.gather(*(self._scan_directory(os.path.join(root, d)) for d in dirs))
+
+
+class ShardedCatalog(object):
+    """ShardedCatalog scans the search directory with a pool of worker
+    processes.
+
+    The coordinating process first catalogs the files directly in
+    the search directory into the session database, which creates or
+    converts that database before any worker reads it. The top level
+    subdirectories are then handed out to the workers one at a time,
+    and each worker scans its subtree into its own shard database
+    with the catalog schema. The shards are
+    then merged into the session database with bulk INSERT ... SELECT
+    statements, the tree hash of the search directory is completed
+    and duplicates are marked in one pass.
+
+    Args:
+        catalog_properties (CatalogProperties): Properties of the
+            session. The scan cannot be resumed.
+        workers (int): Number of worker processes, None uses the
+            number of CPUs.
+
+    Attributes:
+        catalog_properties (CatalogProperties): Same as input.
+        workers (int): Same as input.
+        file_catalog (FileCatalog): The session catalog, set by run.
+
+    """
+
+    def __init__(self, catalog_properties, workers=None):
+
+        if catalog_properties.resume:
+            raise InputError('A parallel scan cannot be resumed.')
+
+        if catalog_properties.session_id is None:
+            catalog_properties.new_session_id()
+
+        self.catalog_properties = catalog_properties
+        self.workers = workers
+        self.file_catalog = None
+
+    def partitions(self):
+        """Return the top level subdirectories to scan in the workers
+        and the names of the files in the search directory.
+        """
+        tops = []
+        names = []
+        with os.scandir(self.catalog_properties.search_dir) as entries:
+            for entry in entries:
+                # Same split as os.walk, which lists but does not
+                # follow links to directories
+                if entry.is_dir():
+                    if (not entry.is_symlink() and
+                            entry.name not in self.catalog_properties.exclude_dirs):
+                        tops.append(entry.name)
+                else:
+                    names.append(entry.name)
+
+        return sorted(tops), names
+
+    def run(self):
+        """Scan, merge and return the FileCatalog of the session."""
+        import multiprocessing
+        import tempfile
+
+        cp = self.catalog_properties
+        search_dir = os.path.normpath(cp.search_dir)
+        tops, names = self.partitions()
+
+        # The session database is opened, and converted if needed,
+        # before the workers read the checksums of earlier sessions
+        # from it
+        self.file_catalog = self.scan_top_level(tops)
+
+        shard_dir = tempfile.mkdtemp(prefix='document_catalog_shards_')
+        settings = {'base_dir': cp.base_dir,
+                    'session_id': cp.session_id,
+                    'previous_database': os.path.abspath(cp.database),
+                    'exclude_dirs': cp.exclude_dirs,
+                    'buffer_size': cp.buffer_size,
+                    'check_file_contents': cp.check_file_contents,
+                    'database_row_buffer': cp.database_row_buffer}
+        jobs = [(os.path.join(search_dir, top),
+                 os.path.join(shard_dir, 'shard{}.db'.format(ii)),
+                 cp.hash_function.name, settings)
+                for ii, top in enumerate(tops)]
+
+        # The shards are removed whether or not the scan succeeds
+        try:
+            with multiprocessing.Pool(self.workers) as pool:
+                shards = []
+                for top, database, count in pool.imap_unordered(_scan_shard_worker, jobs):
+                    if cp.verbose:
+                        print('{}: {} files'.format(top, count))
+                    shards.append(database)
+
+            self.merge(shards)
+
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+        self.complete_search_dir(search_dir, tops, names)
+        self.file_catalog.update_duplicates()
+
+        # The optional stages and the export need the files of the
+        # whole session in memory
+        if cp.chunk_index or cp.emails or cp.extract_metadata or cp.output_file:
+            self.file_catalog._load_session()
+
+            if cp.chunk_index:
+                self.file_catalog.index_chunks()
+
+            if cp.emails:
+                self.file_catalog.catalog_emails()
+
+            if cp.extract_metadata:
+                self.file_catalog.extract_file_metadata()
+
+            self.file_catalog.export()
+
+        return self.file_catalog
+
+    def scan_top_level(self, tops):
+        """Catalog the files directly in the search directory."""
+        cp = self.catalog_properties
+        saved = (cp.exclude_dirs, cp.chunk_index, cp.emails,
+                 cp.extract_metadata, cp.output_file)
+
+        cp.exclude_dirs = list(cp.exclude_dirs) + tops
+        cp.chunk_index = cp.emails = cp.extract_metadata = False
+        cp.output_file = None
+        try:
+            file_catalog = FileCatalog(cp)
+
+        finally:
+            (cp.exclude_dirs, cp.chunk_index, cp.emails,
+             cp.extract_metadata, cp.output_file) = saved
+
+        # Store the excluded directories of the session, not the tops
+        file_catalog.cursor.execute(
+            'UPDATE catalog_properties SET exclude_dirs = ? WHERE session_id = ?;',
+            (json.dumps(list(cp.exclude_dirs)), cp.session_id))
+        file_catalog.connection.commit()
+
+        return file_catalog
+
+    def merge(self, shards):
+        """Copy the files and directories of the shard databases into
+        the session database.
+
+        The file rows are joined to the directories of the session on
+        the relative path so that they refer to the dir_id of the
+        session database.
+        """
+        connection = self.file_catalog.connection
+
+        for shard in shards:
+            connection.execute('ATTACH DATABASE ? AS shard', (shard,))
+            with connection:
+                connection.execute('''
+                INSERT INTO directories
+                (rel_path, parent, name, tree_hash, listing_hash, size, file_count, session_id)
+                SELECT rel_path, parent, name, tree_hash, listing_hash, size, file_count, session_id
+                FROM shard.directories;
+                ''')
+                connection.execute('''
+                INSERT INTO file_entries
+                (dir_id, filename, extension, size, checksum, session_id, file_key)
+                SELECT d.dir_id, f.filename, f.extension, f.size, f.checksum,
+                    f.session_id, f.file_key
+                FROM shard.file_entries f
+                INNER JOIN shard.directories sd ON sd.dir_id = f.dir_id
+                INNER JOIN main.directories d
+                    ON d.session_id IS sd.session_id AND d.rel_path = sd.rel_path;
+                ''')
+                connection.execute('''
+                INSERT OR IGNORE INTO scan_progress SELECT * FROM shard.scan_progress;
+                ''')
+            connection.execute('DETACH DATABASE shard')
+
+            if self.catalog_properties.verbose:
+                print('Merged {}'.format(shard))
+
+    def complete_search_dir(self, search_dir, tops, names):
+        """Store the tree hash of the search directory over its own
+        files and the top level subdirectories scanned by the workers.
+        """
+        cp = self.catalog_properties
+        directory = Directory(search_dir, names, cp)
+        for file_obj in self.file_catalog.files:
+            if os.path.dirname(file_obj.path) == search_dir:
+                directory.add_file(file_obj)
+
+        cursor = self.file_catalog.cursor
+        for top in tops:
+            rel_path = to_catalog_path(os.path.relpath(os.path.join(search_dir, top), cp.base_dir))
+            cursor.execute('''
+            SELECT tree_hash, size, file_count FROM directories
+            WHERE session_id IS ? AND rel_path = ?;
+            ''', (cp.session_id, rel_path))
+            row = cursor.fetchone()
+            if row is None:
+                continue
+
+            child = Directory(os.path.join(search_dir, top), [], cp)
+            child._tree_hash, child.size, child.file_count = row
+            directory.add_directory(child)
+            cursor.execute('''
+            UPDATE directories SET parent = ? WHERE session_id IS ? AND rel_path = ?;
+            ''', (to_catalog_path(directory.relative_path), cp.session_id, rel_path))
+
+        self.file_catalog.insert_directories({search_dir: directory})
+
+
+class CatalogEstimator(object):
+    """CatalogEstimator estimates the size of a catalog before a scan.
+
+    CatalogEstimator uses random descents from the search directory
+    (Knuth's estimator for the size of a tree). Each descent picks a
+    random subdirectory at every level and weights what it finds by
+    the product of the branching factors along the way. The average
+    over all descents is an unbiased estimate of the number of files,
+    directories and bytes. Confidence intervals come from the spread
+    between descents.
+
+    The first sample_bytes of a random file in every visited directory
+    are hashed. This measures the hashing throughput used for the
+    projected scan time. It also gives a rough duplicate rate from
+    the sampled files whose size and partial hash match another
+    sampled file, scaled by the fraction of files sampled.
+
+    Args:
+        catalog_properties (:CatalogProperties:): Provides the search
+            directory, excluded directories and hash function.
+        probes (int): The number of random descents.
+        sample_bytes (int): Bytes hashed from each sampled file.
+        max_stat (int): The most files stat'ed per directory, larger
+            directories are extrapolated from a random subset.
+        seed (int): Seed for the random number generator.
+
+    """
+
+    def __init__(self, catalog_properties, probes=200, sample_bytes=65536,
+                 max_stat=200, seed=None):
+
+        self.catalog_properties = catalog_properties
+        self.probes = probes
+        self.sample_bytes = sample_bytes
+        self.max_stat = max_stat
+        self.random = random.Random(seed)
+
+        if probes < 1:
+            raise InputError('At least one probe is needed for an estimate.')
+
+        self._listings = {}
+        self._samples = {}
+        self._hashed_bytes = 0
+        self._hash_time = 0.0
+        self._list_time = 0.0
+        self._stat_time = 0.0
+        self._lists = 0
+        self._stats = 0
+
+    def list_directory(self, path):
+        """Return (file count, bytes, {extension: count}, subdirectories)
+        for a directory, stat'ing at most max_stat files.
+        """
+        if path in self._listings:
+            return self._listings[path]
+
+        start = time.perf_counter()
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            entries = []
+        self._list_time += time.perf_counter() - start
+        self._lists += 1
+
+        files = []
+        dirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in self.catalog_properties.exclude_dirs:
+                        dirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry)
+            except OSError:
+                pass
+
+        extensions = collections.Counter(os.path.splitext(f.name)[1].lower() for f in files)
+
+        subset = files if len(files) <= self.max_stat else self.random.sample(files, self.max_stat)
+        sizes = []
+        start = time.perf_counter()
+        for entry in subset:
+            try:
+                sizes.append(entry.stat().st_size)
+            except OSError:
+                pass
+        self._stat_time += time.perf_counter() - start
+        self._stats += len(subset)
+
+        total = sum(sizes) * len(files) / len(sizes) if sizes else 0
+        listing = (len(files), total, extensions, dirs, [f.path for f in files])
+        self._listings[path] = listing
+        return listing
+
+    def sample_file(self, path):
+
+        # Hash the start of a file and record its (size, digest) key in
+        # _samples, used to spot likely duplicates.
+
+        if path in self._samples:
+            return
+
+        h = hashlib.new(self.catalog_properties.hash_function.name)
+        start = time.perf_counter()
+        try:
+            size = os.path.getsize(path)
+            with open(path, 'rb') as f:
+                data = f.read(self.sample_bytes)
+        except OSError:
+            return
+        h.update(data)
+        self._hash_time += time.perf_counter() - start
+        self._hashed_bytes += len(data)
+
+        self._samples[path] = (size, h.hexdigest())
+
+    def probe(self):
+        """Make one random descent and return its estimates."""
+        path = self.catalog_properties.search_dir
+        weight = 1
+        estimate = {'files': 0, 'bytes': 0, 'directories': 0,
+                    'extensions': collections.Counter()}
+
+        while True:
+            n_files, n_bytes, extensions, dirs, files = self.list_directory(path)
+            estimate['files'] += weight * n_files
+            estimate['bytes'] += weight * n_bytes
+            estimate['directories'] += weight
+            for extension, count in extensions.items():
+                estimate['extensions'][extension] += weight * count
+
+            if files:
+                self.sample_file(self.random.choice(files))
+
+            if not dirs:
+                return estimate
+
+            weight *= len(dirs)
+            path = self.random.choice(dirs)
+
+    def run(self):
+        """Return a dictionary with the estimates.
+
+        Counts are (estimate, low, high) with a 95% confidence
+        interval. Extensions are the estimated number of files per
+        extension, the duplicate rate is the estimated fraction of
+        files with a duplicate, and scan_seconds projects the time of
+        a full scan from the measured listing, stat and hashing rates.
+        """
+        estimates = [self.probe() for ii in range(self.probes)]
+
+        result = {'probes': self.probes}
+        for key in ['files', 'bytes', 'directories']:
+            result[key] = confidence_interval([e[key] for e in estimates])
+            if key != 'bytes':
+                result[key] = tuple(int(round(v)) for v in result[key])
+
+        extensions = collections.Counter()
+        for e in estimates:
+            extensions.update(e['extensions'])
+        result['extensions'] = dict((ext, count / self.probes)
+                                    for ext, count in extensions.most_common())
+
+        # Duplicate rate, scaled up by the fraction of files sampled
+        keys = collections.Counter(self._samples.values())
+        n_sampled = len(self._samples)
+        n_matched = sum(count for count in keys.values() if count > 1)
+        fraction = min(n_sampled / max(result['files'][0], 1), 1.0)
+        if n_sampled:
+            low, high = wilson_interval(n_matched, n_sampled)
+            result['duplicate_rate'] = tuple(
+                min(v / fraction, 1.0) for v in (n_matched / n_sampled, low, high))
+        else:
+            result['duplicate_rate'] = (0.0, 0.0, 0.0)
+        result['sampled_files'] = n_sampled
+
+        throughput = self._hashed_bytes / self._hash_time if self._hash_time else 0.0
+        per_list = self._list_time / self._lists if self._lists else 0.0
+        per_stat = self._stat_time / self._stats if self._stats else 0.0
+        result['hash_throughput'] = throughput
+
+        def scan_time(n_files, n_bytes, n_dirs):
+            hashing = n_bytes / throughput if throughput else 0.0
+            return hashing + n_files * per_stat + n_dirs * per_list
+
+        result['scan_seconds'] = tuple(
+            scan_time(*values) for values in
+            zip(result['files'], result['bytes'], result['directories']))
+
+        return result
+
+    def report(self, result=None):
+        """Return the estimates as printable text."""
+        if result is None:
+            result = self.run()
+
+        lines = ['Estimate for {} ({} probes, {} files sampled)'.format(
+            self.catalog_properties.search_dir, result['probes'], result['sampled_files'])]
+        lines.append('Files:       {} ({} - {})'.format(*result['files']))
+        lines.append('Directories: {} ({} - {})'.format(*result['directories']))
+        lines.append('Size:        {} ({} - {})'.format(
+            *[get_human_readable(v, 1) for v in result['bytes']]))
+        lines.append('Duplicates:  {:.1%} ({:.1%} - {:.1%})'.format(*result['duplicate_rate']))
+        lines.append('Hashing:     {}/s'.format(get_human_readable(result['hash_throughput'], 1)))
+        lines.append('Scan time:   {} ({} - {})'.format(
+            *[str(datetime.timedelta(seconds=int(v))) for v in result['scan_seconds']]))
+        lines.append('Extensions:')
+        for extension, count in list(result['extensions'].items())[:10]:
+            lines.append('    {:10} {}'.format(extension or '(none)', int(round(count))))
+
+        return '\n'.join(lines)
+
+
+def confidence_interval(values, z=1.96):
+
+    # Return (mean, low, high) for the mean of values using the
+    # normal approximation. The low end is not allowed below zero.
+
+    n = len(values)
+    mean = sum(values) / n
+    if n < 2:
+        return (mean, mean, mean)
+
+    variance = sum((v - mean) ** 2 for v in values) / (n - 1)
+    error = z * (variance / n) ** 0.5
+    return (mean, max(mean - error, 0), mean + error)
+
+
+def wilson_interval(successes, n, z=1.96):
+
+    # Return the (low, high) Wilson score interval for a proportion.
+
+    p = successes / n
+    denominator = 1 + z ** 2 / n
+    centre = (p + z ** 2 / (2 * n)) / denominator
+    error = z * ((p * (1 - p) + z ** 2 / (4 * n)) / n) ** 0.5 / denominator
+    return (max(centre - error, 0.0), min(centre + error, 1.0))
+
+
+class CatalogWatcher(object):
+    """CatalogWatcher keeps the files table of a catalog up to date.
+
+    CatalogWatcher takes a completed FileCatalog and watches its search
+    directory. Changes are collected until the file system has been
+    quiet for the debounce time and are then applied to the files
+    table of the catalog session. Only new and modified files are
+    hashed, the duplicate column is only updated for the checksums
+    that were touched, and only the changed directories and their
+    ancestors are hashed again in the directories table.
+
+    On Linux, changes are reported by inotify. Elsewhere, or if
+    inotify is not available, the tree is polled by comparing stat
+    snapshots.
+
+    Args:
+        file_catalog (:FileCatalog:): The catalog to keep up to date.
+        interval (float): Seconds between polls, or the longest wait
+            for inotify events.
+        debounce (float): Seconds without changes before the collected
+            changes are applied.
+        use_inotify (bool): Use inotify. If None, inotify is used when
+            it is available.
+
+    Attributes:
+        snapshot (dict): Directory path to a tuple of a dictionary of
+            filename to (size, mtime) and a set of subdirectory names.
+
+    """
+
+    # inotify event masks
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+
+    def __init__(self, file_catalog, interval=2.0, debounce=1.0, use_inotify=None):
+
+        self.file_catalog = file_catalog
+        self.catalog_properties = file_catalog.catalog_properties
+        self.connection = file_catalog.connection
+        self.cursor = self.connection.cursor()
+
+        self.interval = interval
+        self.debounce = debounce
+
+        self.snapshot = {}
+        self._polled = {}
+        self._inotify = None
+        self._watches = {}
+
+        if use_inotify is None:
+            use_inotify = sys.platform.startswith('linux')
+
+        if use_inotify:
+            self._inotify = self._init_inotify()
+
+        self.take_snapshot()
+        self.file_catalog.update_duplicates()
+
+    def run(self, duration=None):
+        """Watch for changes until interrupted or for duration seconds."""
+        start = time.monotonic()
+        dirty = set()
+        last_change = start
+
+        try:
+            while duration is None or time.monotonic() - start < duration:
+                changed = self.wait_for_changes()
+                if changed:
+                    dirty |= changed
+                    last_change = time.monotonic()
+
+                elif dirty and time.monotonic() - last_change >= self.debounce:
+                    self.refresh(dirty)
+                    dirty = set()
+
+        except KeyboardInterrupt:
+            pass
+
+        if dirty:
+            self.refresh(dirty)
+
+    def wait_for_changes(self):
+        """Return the set of directories that may have changed."""
+        if self._inotify is not None:
+            return self._read_inotify(min(self.interval, self.debounce))
+
+        time.sleep(self.interval)
+
+        # Compare with the previous poll rather than the snapshot, so a
+        # change is only reported once and the debounce can expire
+        changed = set()
+        for path in list(self.snapshot):
+            entries = self.scan_directory(path)
+            if entries != self._polled.get(path, self.snapshot[path]):
+                changed.add(path)
+            self._polled[path] = entries
+
+        return changed
+
+    def take_snapshot(self):
+        self.snapshot = {}
+        self._polled = {}
+        self._snapshot_tree(self.catalog_properties.search_dir)
+
+    def _snapshot_tree(self, top):
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            entries = self.scan_directory(path)
+            if entries is None:
+                continue
+
+            self.snapshot[path] = entries
+            self._add_watch(path)
+            stack += [os.path.join(path, d) for d in entries[1]]
+
+    def scan_directory(self, path):
+        """Return ({filename: (size, mtime)}, {subdirectory names}) or
+        None if the directory no longer exists.
+        """
+        files = {}
+        dirs = set()
+
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in self.catalog_properties.exclude_dirs:
+                                dirs.add(entry.name)
+
+                        elif entry.is_file():
+                            st = entry.stat()
+                            files[entry.name] = (st.st_size, st.st_mtime_ns)
+
+                    except OSError:
+                        pass
+
+        except OSError:
+            return None
+
+        return files, dirs
+
+    def refresh(self, dirty):
+        """Apply the changes in the dirty directories to the database."""
+        self._changes = collections.Counter()
+        self._checksums = set()
+        self._touched = set()
+        self._removed = set()
+
+        # Parents first so removed subtrees are handled once
+        for path in sorted(dirty, key=lambda p: p.count(os.path.sep)):
+            if path in self.snapshot or os.path.isdir(path):
+                self.refresh_directory(path)
+
+        self.update_directories()
+        self._polled = {}
+        self.connection.commit()
+        self.file_catalog.update_duplicates(self._checksums)
+
+        if self.catalog_properties.verbose and self._changes:
+            print(', '.join('{} {}'.format(v, k) for k, v in sorted(self._changes.items())))
+
+        return dict(self._changes)
+
+    def refresh_directory(self, path):
+        old_files, old_dirs = self.snapshot.get(path, ({}, set()))
+        entries = self.scan_directory(path)
+
+        if entries is None:
+            self.remove_tree(path)
+            return
+
+        files, dirs = entries
+        self._touched.add(path)
+
+        for name in set(old_files) - set(files):
+            self.remove_file(os.path.join(path, name))
+
+        for name, signature in files.items():
+            if old_files.get(name) != signature:
+                self.update_file(os.path.join(path, name), name in old_files)
+
+        for name in set(old_dirs) - dirs:
+            self.remove_tree(os.path.join(path, name))
+
+        self.snapshot[path] = entries
+
+        for name in dirs - set(old_dirs):
+            new_dir = os.path.join(path, name)
+            before = set(self.snapshot)
+            self._snapshot_tree(new_dir)
+            for sub_dir in set(self.snapshot) - before:
+                self._touched.add(sub_dir)
+                for f in self.snapshot[sub_dir][0]:
+                    self.update_file(os.path.join(sub_dir, f), False)
+
+    def remove_tree(self, path):
+        prefix = path + os.path.sep
+        for sub_dir in [p for p in self.snapshot if p == path or p.startswith(prefix)]:
+            self._removed.add(sub_dir)
+            for name in self.snapshot.pop(sub_dir)[0]:
+                self.remove_file(os.path.join(sub_dir, name))
+
+    def update_directories(self):
+        """Hash the changed directories and their ancestors up to the
+        search directory again, and delete the rows of the removed
+        directories.
+        """
+        cp = self.catalog_properties
+        cursor = self.cursor
+
+        for path in self._removed - set(self.snapshot):
+            rel_path = to_catalog_path(os.path.relpath(path, cp.base_dir))
+            cursor.execute('DELETE FROM directories WHERE session_id IS ? AND rel_path = ?;',
+                           (cp.session_id, rel_path))
+            self.file_catalog._dir_ids.pop((cp.session_id, rel_path), None)
+
+        paths = set()
+        for path in self._touched | set(os.path.dirname(p) for p in self._removed):
+            while path in self.snapshot and path not in paths:
+                paths.add(path)
+                if path == cp.search_dir:
+                    break
+                path = os.path.dirname(path)
+
+        rel_paths = set(to_catalog_path(os.path.relpath(p, cp.base_dir)) for p in paths)
+        directories = {}
+        for path in paths:
+            files = self.snapshot[path][0]
+            directory = Directory(path, files, cp, files)
+            if path != cp.search_dir:
+                directory.parent = os.path.relpath(os.path.dirname(path), cp.base_dir)
+
+            cursor.execute('''
+            SELECT f.filename, lower(hex(f.checksum)), f.size
+            FROM file_entries f
+            INNER JOIN directories d ON d.dir_id = f.dir_id
+            WHERE d.session_id IS ? AND d.rel_path = ?;
+            ''', (cp.session_id, to_catalog_path(directory.relative_path)))
+            for name, checksum, size in cursor.fetchall():
+                directory.files.append((name, checksum))
+                directory.size += size
+                directory.file_count += 1
+
+            # Unchanged subdirectories keep their stored hashes, the
+            # changed ones are linked by insert_directories
+            cursor.execute('''
+            SELECT rel_path, tree_hash, size, file_count FROM directories
+            WHERE session_id IS ? AND parent = ?;
+            ''', (cp.session_id, to_catalog_path(directory.relative_path)))
+            for rel_path, tree_hash, size, file_count in cursor.fetchall():
+                if rel_path in rel_paths or tree_hash is None:
+                    continue
+                child = Directory(os.path.join(cp.base_dir, from_catalog_path(rel_path)), [], cp)
+                child._tree_hash, child.size, child.file_count = tree_hash, size, file_count
+                directory.add_directory(child)
+
+            directories[path] = directory
+
+        self.file_catalog.insert_directories(directories)
+
+    def _delete_row(self, path):
+        rel_path = os.path.relpath(path, self.catalog_properties.base_dir)
+        self.cursor.execute('''
+        SELECT f.file_id, lower(hex(f.checksum))
+        FROM file_entries f
+        INNER JOIN directories d ON d.dir_id = f.dir_id
+        WHERE d.session_id = ? AND d.rel_path = ? AND f.filename = ?;
+        ''', (self.catalog_properties.session_id, to_catalog_path(os.path.dirname(rel_path)) or '.',
+              os.path.basename(rel_path)))
+        rows = self.cursor.fetchall()
+        self._checksums.update(checksum for _, checksum in rows)
+        self.cursor.executemany('DELETE FROM file_entries WHERE file_id = ?',
+                                [(file_id,) for file_id, _ in rows])
+        return len(rows)
+
+    def remove_file(self, path):
+        if self._delete_row(path):
+            self._changes['deleted'] += 1
+
+    def update_file(self, path, existing):
+        try:
+            file_obj = File(path, self.catalog_properties)
+            row = file_obj.as_tuple()
+
+        except Exception:
+            print('Error loading {}'.format(path))
+            return
+
+        self._delete_row(path)
+        self.file_catalog.insert_file_rows([row], replace=True)
+        self._checksums.add(file_obj.checksum)
+        self._changes['updated' if existing else 'inserted'] += 1
+
+    def _init_inotify(self):
+        import ctypes
+        import ctypes.util
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        except (OSError, AttributeError):
+            return None
+
+        if fd < 0:
+            return None
+
+        self._libc = libc
+        return fd
+
+    def _add_watch(self, path):
+        if self._inotify is None:
+            return
+
+        mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE |
+                self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE |
+                self.IN_DELETE | self.IN_DELETE_SELF | self.IN_MOVE_SELF)
+        wd = self._libc.inotify_add_watch(self._inotify, os.fsencode(path), mask)
+        if wd >= 0:
+            self._watches[wd] = path
+
+    def _read_inotify(self, timeout):
+        import select
+
+        readable, _, _ = select.select([self._inotify], [], [], timeout)
+        if not readable:
+            return set()
+
+        try:
+            data = os.read(self._inotify, 65536)
+
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            offset += 16 + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost, check every directory
+                return set(self.snapshot)
+
+            path = self._watches.get(wd)
+            if path is None:
+                continue
+
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                changed.add(os.path.dirname(path))
+                self._watches.pop(wd, None)
+
+            else:
+                changed.add(path)
+
+        return changed
+
+    def close(self):
+        if self._inotify is not None:
+            os.close(self._inotify)
+            self._inotify = None
+
+
+CatalogRecord = collections.namedtuple(
+    'CatalogRecord', ['file_key', 'checksum', 'base_dir', 'rel_path',
+                      'filename', 'extension', 'size', 'session_id'])
+
+
+class CatalogQuery(object):
+    """CatalogQuery provides read-only lookups on a catalog database.
+
+    CatalogQuery answers questions about an existing catalog without
+    scanning the file system or loading the catalog into memory. Each
+    lookup uses an index on the file_entries table, or on the files
+    table of a database written before the compact schema, and
+    returns a generator of CatalogRecord tuples.
+
+    Args:
+        database (str): Filename of the SQLite3 catalog database. The
+            database is opened read-only.
+        session_id (str): Restrict lookups to one session. If None,
+            all sessions in the database are searched.
+
+    Attributes:
+        database (str): Same as input.
+        session_id (str): Same as input.
+        compact (bool): Whether the database uses the compact schema.
+
+    """
+
+    _select = '''
+        SELECT lower(hex(f.file_key)), lower(hex(f.checksum)), cp.base_dir,
+            {} AS rel_path, f.filename, f.extension, f.size, f.session_id
+        FROM file_entries f
+        INNER JOIN directories d ON d.dir_id = f.dir_id
+        INNER JOIN catalog_properties cp ON f.session_id = cp.session_id
+        '''.format(rel_path_sql())
+
+    _legacy_select = '''
+        SELECT f.file_key, f.checksum, cp.base_dir, f.rel_path, f.filename,
+            f.extension, f.size, f.session_id
+        FROM files f
+        INNER JOIN catalog_properties cp ON f.session_id = cp.session_id
+        '''
+
+    def __init__(self, database, session_id=None):
+
+        if not os.path.isfile(database):
+            raise InputError('Catalog database does not exist.\n{}'.format(database))
+
+        self.database = database
+        self.session_id = session_id
+
+        self.connection = sqlite3.connect(
+            read_only_uri(database), uri=True)
+        self.compact = schema_version(self.connection) >= COMPACT_SCHEMA_VERSION
+
+    def close(self):
+        self.connection.close()
+
+    def _digest(self, hex_digest):
+        return hex_to_blob(hex_digest) if self.compact else hex_digest
+
+    def _records(self, where, params=(), order='rel_path'):
+        if self.session_id is not None:
+            where += ' AND f.session_id = ?'
+            params = tuple(params) + (self.session_id,)
+
+        select = self._select if self.compact else self._legacy_select
+        cursor = self.connection.execute(
+            '{} WHERE {} ORDER BY {}'.format(select, where, order), params)
+
+        for row in cursor:
+            record = CatalogRecord(*row)
+            if self.compact:
+                record = record._replace(rel_path=from_catalog_path(record.rel_path))
+            yield record
+
+    def files(self):
+        """All files ordered by checksum, then relative path."""
+        return self._records('1', order='f.checksum, rel_path')
+
+    def by_checksum(self, checksum):
+        """All copies of the content with the given checksum."""
+        return self._records('f.checksum = ?', (self._digest(checksum),))
+
+    def by_key(self, file_key):
+        """The file with the given file key, or None."""
+        return next(self._records('f.file_key = ?', (self._digest(file_key),)), None)
+
+    def by_path_prefix(self, prefix):
+        """All files whose relative path starts with prefix."""
+        if not prefix:
+            return self._records('1')
+
+        # A range on the indexed column instead of LIKE so the index
+        # is used and the match is case sensitive
+        if self.compact:
+            prefix = to_catalog_path(prefix)
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        if not self.compact:
+            return self._records('f.rel_path >= ? AND f.rel_path < ?', (prefix, upper))
+
+        # The files are in directories under the prefix, or the prefix
+        # ends inside a filename of its parent directory
+        return self._records(
+            '(d.rel_path >= ? AND d.rel_path < ? OR d.rel_path = ?) '
+            'AND {0} >= ? AND {0} < ?'.format(rel_path_sql()),
+            (prefix, upper, prefix.rpartition('/')[0] or '.', prefix, upper))
+
+    def by_extension(self, extension):
+        """All files with the given extension, including the dot."""
+        return self._records('f.extension = ?', (extension,))
+
+    def duplicate_groups(self):
+        """Yield (checksum, [CatalogRecord, ...]) for every checksum
+        found more than once.
+        """
+        where = '''f.checksum IN (
+            SELECT checksum FROM {}
+            WHERE checksum IS NOT NULL{}
+            GROUP BY checksum HAVING COUNT(*) > 1)'''
+        params = ()
+        table = 'file_entries' if self.compact else 'files'
+        if self.session_id is not None:
+            where = where.format(table, ' AND session_id = ?')
+            params = (self.session_id,)
+        else:
+            where = where.format(table, '')
+
+        records = self._records(where, params, order='f.checksum, rel_path')
+        for checksum, group in itertools.groupby(records, key=lambda r: r.checksum):
+            yield checksum, list(group)
+
+
+class SessionDiff(object):
+    """SessionDiff reports the changes between two sessions of a
+    catalog database.
+
+    Files are matched on their relative path. A file found in both
+    sessions with a different checksum is modified. The files found
+    only in the new session are paired one to one with files of the
+    same checksum found only in the old session, preferring the same
+    filename; each pair is a moved file, and the files left over are
+    added or removed. Every comparison is a join on the indexed
+    directories and file_entries tables, and the unmatched files and
+    the moves are collected once into temporary tables, so large
+    sessions are compared without loading them into memory.
+
+    Args:
+        database (str): Filename of the SQLite3 catalog database. The
+            database is opened read-only.
+        old_session (str): The session ID to compare from.
+        new_session (str): The session ID to compare to.
+
+    Attributes:
+        database (str): Same as input.
+        old_session (str): Same as input.
+        new_session (str): Same as input.
+
+    """
+
+    def __init__(self, database, old_session, new_session):
+
+        if not os.path.isfile(database):
+            raise InputError('Catalog database does not exist.\n{}'.format(database))
+
+        self.database = database
+        self.old_session = old_session
+        self.new_session = new_session
+
+        self.connection = sqlite3.connect(
+            read_only_uri(database), uri=True)
+
+        if schema_version(self.connection) < COMPACT_SCHEMA_VERSION:
+            raise InputError('Catalog database uses the original schema, '
+                             'open it with FileCatalog to convert it.\n{}'.format(database))
+
+        for session_id in (old_session, new_session):
+            cursor = self.connection.execute(
+                'SELECT 1 FROM catalog_properties WHERE session_id = ?', (session_id,))
+            if cursor.fetchone() is None:
+                raise InputError('Session {} is not in the catalog.'.format(session_id))
+
+        self._collect('diff_removed', old_session, new_session)
+        self._collect('diff_added', new_session, old_session)
+        self._pair_moves()
+
+    def close(self):
+        self.connection.close()
+
+    def _collect(self, table, session_id, other_session):
+
+        # The files of session_id without a file at the same relative
+        # path in other_session
+
+        self.connection.execute('DROP TABLE IF EXISTS temp.{}'.format(table))
+        self.connection.execute('''
+        CREATE TEMP TABLE {table} AS
+        SELECT {rel_path} AS rel_path, f.filename, f.checksum, f.size,
+            row_number() OVER (PARTITION BY f.checksum, f.filename
+                               ORDER BY {rel_path}) AS name_copy
+        FROM directories d
+        INNER JOIN file_entries f ON f.dir_id = d.dir_id
+        LEFT JOIN directories od ON od.session_id = ? AND od.rel_path = d.rel_path
+        LEFT JOIN file_entries o ON o.dir_id = od.dir_id AND o.filename = f.filename
+        WHERE d.session_id = ? AND o.file_id IS NULL;
+        '''.format(table=table, rel_path=rel_path_sql()), (other_session, session_id))
+        self.connection.execute(
+            'CREATE INDEX temp.{0}_checksum ON {0}(checksum, filename, name_copy)'.format(table))
+
+    def _pair_moves(self):
+
+        # Pair the copies with the same checksum and filename first,
+        # then the remaining copies with the same checksum, in
+        # relative path order
+
+        self.connection.execute('DROP TABLE IF EXISTS temp.diff_moved')
+        self.connection.execute('''
+        CREATE TEMP TABLE diff_moved AS
+        SELECT r.rel_path AS old_rel_path, a.rel_path, a.checksum, a.size
+        FROM diff_added a
+        INNER JOIN diff_removed r ON r.checksum = a.checksum
+            AND r.filename = a.filename AND r.name_copy = a.name_copy;
+        ''')
+        self.connection.execute('CREATE INDEX temp.diff_moved_rel_path ON diff_moved(rel_path)')
+        self.connection.execute('CREATE INDEX temp.diff_moved_old_rel_path ON diff_moved(old_rel_path)')
+        self.connection.execute('''
+        INSERT INTO diff_moved
+        WITH a AS (
+            SELECT rel_path, checksum, size,
+                row_number() OVER (PARTITION BY checksum ORDER BY rel_path) AS copy
+            FROM diff_added
+            WHERE checksum IS NOT NULL
+                AND rel_path NOT IN (SELECT rel_path FROM diff_moved)),
+        r AS (
+            SELECT rel_path, checksum,
+                row_number() OVER (PARTITION BY checksum ORDER BY rel_path) AS copy
+            FROM diff_removed
+            WHERE checksum IS NOT NULL
+                AND rel_path NOT IN (SELECT old_rel_path FROM diff_moved))
+        SELECT r.rel_path, a.rel_path, a.checksum, a.size
+        FROM a INNER JOIN r ON r.checksum = a.checksum AND r.copy = a.copy;
+        ''')
+
+    # The change queries, each with the number of relative path
+    # columns at the start of its rows. The parameters are the two
+    # session IDs.
+    _queries = {
+        'added': ('''
+        SELECT rel_path, lower(hex(checksum)), size FROM diff_added
+        WHERE rel_path NOT IN (SELECT rel_path FROM diff_moved)
+        ORDER BY rel_path
+        ''', 1),
+        'removed': ('''
+        SELECT rel_path, lower(hex(checksum)), size FROM diff_removed
+        WHERE rel_path NOT IN (SELECT old_rel_path FROM diff_moved)
+        ORDER BY rel_path
+        ''', 1),
+        'moved': ('''
+        SELECT old_rel_path, rel_path, lower(hex(checksum)), size FROM diff_moved
+        ORDER BY rel_path
+        ''', 2),
+        'modified': ('''
+        SELECT {rel_path}, lower(hex(o.checksum)), lower(hex(f.checksum)), o.size, f.size
+        FROM directories d
+        INNER JOIN file_entries f ON f.dir_id = d.dir_id
+        INNER JOIN directories od ON od.session_id = :old AND od.rel_path = d.rel_path
+        INNER JOIN file_entries o ON o.dir_id = od.dir_id AND o.filename = f.filename
+        WHERE d.session_id = :new AND o.checksum IS NOT f.checksum
+        ORDER BY 1
+        '''.format(rel_path=rel_path_sql()), 1),
+        'directory_deltas': ('''
+        SELECT rel_path, old_size, size, size - old_size AS delta FROM (
+            SELECT n.rel_path, COALESCE(o.size, 0) AS old_size, COALESCE(n.size, 0) AS size
+            FROM directories n
+            LEFT JOIN directories o ON o.session_id = :old AND o.rel_path = n.rel_path
+            WHERE n.session_id = :new
+            UNION ALL
+            SELECT o.rel_path, COALESCE(o.size, 0), 0
+            FROM directories o
+            LEFT JOIN directories n ON n.session_id = :new AND n.rel_path = o.rel_path
+            WHERE o.session_id = :old AND n.dir_id IS NULL)
+        WHERE delta != 0
+        ORDER BY abs(delta) DESC, rel_path
+        ''', 1)}
+
+    def _rows(self, name, limit=None):
+
+        # Fetch the rows of a change query, the first limit of them if
+        # given, with the relative paths in the form of this platform
+
+        sql, paths = self._queries[name]
+        if limit is not None:
+            sql = '{} LIMIT {:d}'.format(sql, limit)
+        params = {'old': self.old_session, 'new': self.new_session}
+        return [tuple(from_catalog_path(v) for v in row[:paths]) + row[paths:]
+                for row in self.connection.execute(sql, params)]
+
+    def count(self, name):
+        """Return the number of rows of a change, one of 'added',
+        'removed', 'moved', 'modified' or 'directory_deltas'.
+        """
+        sql, paths = self._queries[name]
+        params = {'old': self.old_session, 'new': self.new_session}
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM ({})'.format(sql), params).fetchone()[0]
+
+    def added(self, limit=None):
+        """Return [(rel_path, checksum, size), ...] of the new files."""
+        return self._rows('added', limit)
+
+    def removed(self, limit=None):
+        """Return [(rel_path, checksum, size), ...] of the files that
+        are gone.
+        """
+        return self._rows('removed', limit)
+
+    def moved(self, limit=None):
+        """Return [(old_rel_path, rel_path, checksum, size), ...] of the
+        files found under a new path.
+        """
+        return self._rows('moved', limit)
+
+    def modified(self, limit=None):
+        """Return [(rel_path, old_checksum, checksum, old_size, size), ...]
+        of the files with the same path and different contents.
+        """
+        return self._rows('modified', limit)
+
+    def directory_deltas(self, limit=None):
+        """Return [(rel_path, old_size, size, delta), ...] of the
+        directories whose total size changed, largest change first.
+
+        The sizes are the subtree sizes of the directories table, so a
+        change is counted in every directory above it. A directory
+        missing from a session has size 0 there.
+        """
+        return self._rows('directory_deltas', limit)
+
+    def report(self, max_rows=20):
+        """Return the changes as printable text. Each change is counted
+        and at most max_rows of its rows are listed.
+        """
+        lines = ['Changes from {} to {}'.format(self.old_session, self.new_session)]
+
+        sections = [('Added', 'added', lambda r: r[0]),
+                    ('Removed', 'removed', lambda r: r[0]),
+                    ('Modified', 'modified', lambda r: '{} ({} -> {})'.format(
+                        r[0], get_human_readable(r[3] or 0), get_human_readable(r[4] or 0))),
+                    ('Moved', 'moved', lambda r: '{} -> {}'.format(r[0], r[1])),
+                    ('Directories changed', 'directory_deltas', lambda r: '{:>10} {}'.format(
+                        ('+' if r[3] > 0 else '-') + get_human_readable(abs(r[3])), r[0]))]
+
+        for title, name, describe in sections:
+            count = self.count(name)
+            lines.append('{}: {}'.format(title, count))
+            for row in self._rows(name, max_rows):
+                lines.append('    {}'.format(describe(row)))
+            if count > max_rows:
+                lines.append('    ...')
+
+        return '\n'.join(lines)
+
+
+def copy_catalog(database, dest_dir, session_id=None, workers=8,
+                 link_duplicates=True, verify=True, allow_overwrite=False,
+                 verbose=False):
+
+    """
+    copy_catalog(database, dest_dir)
+
+    Copy the files of a catalog database to dest_dir keeping their
+    relative paths. Each unique checksum is copied once and checked
+    against the catalog checksum on the destination. The other files
+    with the same checksum are hard linked to that copy. If
+    link_duplicates is False, or the link cannot be made, they are
+    only recorded in the manifest.
+
+    Progress is recorded in the copy_progress table of the database,
+    which is also the manifest of where every file ended up, so an
+    interrupted copy can be run again and continues where it stopped.
+
+    One session is copied to a destination. If session_id is None the
+    database must hold a single session, and a destination that
+    already holds a copy of another session is refused, since the same
+    relative path can have different contents in each session. An
+    InputError is raised in both cases.
+
+    A file already at a destination path is only replaced if
+    allow_overwrite is True. Otherwise the group of files with its
+    checksum fails, unless the file is a complete copy left by an
+    interrupted run, which is kept.
+
+    Returns a dictionary with the number of files per method.
+    """
+
+    import concurrent.futures
+
+    connection = sqlite3.connect(database)
+    cursor = connection.cursor()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS copy_progress
+    (dest_dir text,
+    file_key text,
+    checksum text,
+    source_path text,
+    dest_path text,
+    method text,
+    PRIMARY KEY(dest_dir, file_key));
+    ''')
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(copy_progress)')]
+    if 'session_id' not in columns:
+        cursor.execute('ALTER TABLE copy_progress ADD COLUMN session_id text')
+    connection.commit()
+
+    dest_dir = os.path.realpath(dest_dir)
+
+    if session_id is None:
+        sessions = [row[0] for row in cursor.execute('SELECT session_id FROM catalog_properties')]
+        if len(sessions) != 1:
+            connection.close()
+            raise InputError('Choose one of the sessions to copy: {}'.format(', '.join(sessions)))
+        session_id = sessions[0]
+
+    cursor.execute('''
+    SELECT DISTINCT session_id FROM copy_progress
+    WHERE dest_dir = ? AND session_id IS NOT ?;''', (dest_dir, session_id))
+    others = [row[0] for row in cursor.fetchall()]
+    if others:
+        connection.close()
+        raise InputError('{} already holds a copy of session {}'.format(dest_dir, others[0]))
+
+    cursor.execute('''
+    SELECT file_key, checksum, dest_path, method FROM copy_progress
+    WHERE dest_dir = ?;''', (dest_dir,))
+    done = set()
+    originals = {}
+    for file_key, checksum, dest_path, method in cursor.fetchall():
+        done.add(file_key)
+        if method == 'copied':
+            originals[checksum] = dest_path
+
+    cursor.execute('SELECT session_id, hash_function, hash_buffer_size FROM catalog_properties')
+    hash_functions = dict((row[0], row[1:]) for row in cursor.fetchall())
+
+    query = CatalogQuery(database, session_id)
+    summary = collections.Counter()
+
+    def copy_group(checksum, records):
+        rows = []
+        pending = [r for r in records if r.file_key not in done]
+        original = originals.get(checksum)
+
+        if original is None:
+            record = pending.pop(0)
+            source = os.path.join(record.base_dir, record.rel_path)
+            dest = os.path.join(dest_dir, record.rel_path)
+            hash_name, buffer_size = hash_functions[record.session_id]
+
+            if os.path.lexists(dest) and not allow_overwrite:
+                if compute_checksum_for_file(dest, hashlib.new(hash_name), buffer_size) != checksum:
+                    raise FileExistsError('{} already exists, allow overwrite to replace it'.format(dest))
+
+            else:
+                for attempt in range(2):
+                    _copy_file(source, dest)
+                    if not verify or compute_checksum_for_file(
+                            dest, hashlib.new(hash_name), buffer_size) == checksum:
+                        break
+                else:
+                    raise OSError('Checksum mismatch after copy: {}'.format(source))
+
+            rows.append((dest_dir, record.file_key, checksum, source, dest, 'copied', session_id))
+            original = dest
+
+        for record in pending:
+            source = os.path.join(record.base_dir, record.rel_path)
+            dest = os.path.join(dest_dir, record.rel_path)
+            method = 'manifest'
+
+            if _same_file(original, dest):
+                # Never remove the copy the other files link to
+                method = 'linked'
+
+            elif link_duplicates and os.path.lexists(dest) and not allow_overwrite:
+                raise FileExistsError('{} already exists, allow overwrite to replace it'.format(dest))
+
+            elif link_duplicates:
+                try:
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    if os.path.lexists(dest):
+                        os.remove(dest)
+                    os.link(original, dest)
+                    method = 'linked'
+
+                except OSError:
+                    pass
+
+            rows.append((dest_dir, record.file_key, checksum, source,
+                         original if method == 'manifest' else dest, method, session_id))
+
+        return rows
+
+    def record(future, checksum):
+        try:
+            rows = future.result()
+
+        except OSError as e:
+            print('Error copying checksum {}: {}'.format(checksum, e))
+            summary['failed'] += 1
+            return
+
+        cursor.executemany(
+            '''INSERT OR REPLACE INTO copy_progress
+            (dest_dir, file_key, checksum, source_path, dest_path, method, session_id)
+            VALUES (?,?,?,?,?,?,?)''', rows)
+        connection.commit()
+        for row in rows:
+            summary[row[5]] += 1
+            if verbose:
+                print('{}: {}'.format(row[5], row[4]))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            in_flight = {}
+            groups = itertools.groupby(query.files(), key=lambda r: r.checksum)
+
+            for checksum, records in groups:
+                records = list(records)
+                if checksum is None:
+                    summary['skipped'] += len(records)
+                    continue
+
+                if all(r.file_key in done for r in records):
+                    summary['done'] += len(records)
+                    continue
+
+                in_flight[executor.submit(copy_group, checksum, records)] = checksum
+
+                # Bound the number of queued groups so memory stays flat
+                if len(in_flight) >= workers * 4:
+                    finished, _ = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        record(future, in_flight.pop(future))
+
+            for future in concurrent.futures.as_completed(in_flight):
+                record(future, in_flight[future])
+
+    finally:
+        query.close()
+        connection.close()
+
+    return dict(summary)
+
+
+def _same_file(a, b):
+
+    # True if both paths name the same file on disk
+
+    try:
+        return a == b or os.path.samefile(a, b)
+
+    except OSError:
+        return False
+
+
+def _copy_file(source, dest):
+
+    # Copy through a temporary name so an interrupted copy never
+    # leaves a truncated file under the final name.
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    partial = dest + '.partial'
+    shutil.copy2(source, partial)
+    os.replace(partial, dest)
+
+
+def copy_files(source_dir, dest_dir, allow_dest_exist=False):
+
+    """
+    copy_files(source_dir, dest_dir)
+
+    Copy a directory tree preserving file times and mark the copied
+    files read-only, the equivalent of
+
+    robocopy source_dir dest_dir *.* /E /COPY:DT /DCOPY:DAT
+    attrib +R dest_dir\\* /S
+    """
+
+    if not allow_dest_exist:
+        if os.path.isdir(dest_dir):
+            # Destination directory already exists
+            print('''Destination directory exists. Rerun 
+                     with --allow-overwrite flag to enable 
+                     copying. Warning, this may cause overwriting 
+                     of existing files.''')
+            
+            return -1
+
+    try:
+        shutil.copytree(source_dir, dest_dir, copy_function=shutil.copy2,
+                        dirs_exist_ok=True)
+
+        for root, dirs, files in os.walk(dest_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                mode = os.stat(path).st_mode
+                os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+    except (OSError, shutil.Error):
+        print('Copy did not complete correctly.')
+        return -2
+
+    return 1
+
+
+def compute_checksum_for_file(file_path, hash_function, buffer_size):
+
+    h = hashlib.new(hash_function.name)
+
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read(buffer_size)
+            while data:
+                h.update(data)
+                data = f.read(buffer_size)
+
+        return h.hexdigest()
+
+    except PermissionError:
+        return None
+
+    return None
+    
+# Gear table for the rolling hash used by content-defined chunking,
+# derived from sha1 so it is identical in every process
+_GEAR = [int.from_bytes(hashlib.sha1(bytes([ii])).digest()[:8], 'big')
+         for ii in range(256)]
+
+# Number of hash positions computed per numpy pass
+_GEAR_BLOCK = 8192
+
+
+def find_chunk_boundary(data, min_size, max_size, mask):
+
+    # Return the length of the next chunk at the start of data using a
+    # Gear rolling hash. Shifting left means only the last 64 bytes
+    # affect the high bits tested by the mask, so hashing starts 64
+    # bytes before the minimum chunk size. The hash is computed with
+    # numpy when it is installed and byte by byte otherwise; both give
+    # the same boundaries.
+
+    n = min(len(data), max_size)
+    if n <= min_size:
+        return n
+
+    try:
+        import numpy as np
+
+    except ImportError:
+        np = None
+
+    if np is not None:
+        return _find_chunk_boundary_numpy(np, data, min_size, n, mask)
+
+    gear = _GEAR
+    h = 0
+    for ii in range(max(min_size - 64, 0), n):
+        h = ((h << 1) + gear[data[ii]]) & 0xFFFFFFFFFFFFFFFF
+        if ii >= min_size and not h & mask:
+            return ii + 1
+
+    return n
+
+
+def _find_chunk_boundary_numpy(np, data, min_size, n, mask):
+
+    # The hash at byte ii is the sum of gear[data[ii - j]] << j for the
+    # last 64 bytes, modulo 2**64. It is built for a block of positions
+    # at a time by doubling: after summing windows of 1, 2, 4, ... 32
+    # bytes shifted by their width, each position holds its 64 byte
+    # window. Bytes before the start of hashing count as zero.
+
+    gear = np.array(_GEAR, dtype=np.uint64)
+    mask = np.uint64(mask)
+    start = max(min_size - 64, 0)
+    view = np.frombuffer(data, dtype=np.uint8, count=n)
+
+    pos = min_size
+    while pos < n:
+        end = min(pos + _GEAR_BLOCK, n)
+        lo = max(pos - 63, start)
+        h = np.zeros(end - pos + 63, dtype=np.uint64)
+        h[lo - (pos - 63):] = gear[view[lo:end]]
+
+        width = 1
+        while width < 64:
+            h[width:] = h[width:] + (h[:-width] << np.uint64(width))
+            width *= 2
+
+        hits = np.flatnonzero((h[63:] & mask) == 0)
+        if hits.size:
+            return pos + int(hits[0]) + 1
+
+        pos = end
+
+    return n
+
+
+def compute_chunks_for_file(file_path, hash_function, buffer_size, average_size=8192):
+
+    """
+    compute_chunks_for_file(file_path, hash_function, buffer_size)
+
+    Split a file into content-defined chunks and yield a tuple
+    (offset, length, digest) for each chunk. Chunk boundaries depend
+    only on the surrounding bytes, so an insertion or deletion only
+    changes the chunks around the edit. The file is streamed in
+    buffer_size reads.
+    """
+
+    min_size = average_size // 4
+    max_size = average_size * 8
+    bits = average_size.bit_length() - 1
+    mask = ((1 << bits) - 1) << (64 - bits)
+
+    offset = 0
+    pending = b''
+
+    with open(file_path, 'rb') as f:
+        data = f.read(buffer_size)
+        while data or pending:
+            pending += data
+
+            # Keep at least max_size bytes pending until the end of the
+            # file so every boundary search sees a full window
+            while pending and (len(pending) >= max_size or not data):
+                cut = find_chunk_boundary(pending, min_size, max_size, mask)
+                h = hashlib.new(hash_function.name)
+                h.update(pending[:cut])
+                yield (offset, cut, h.hexdigest())
+
+                offset += cut
+                pending = pending[cut:]
+
+            data = f.read(buffer_size)
+
+
+def _chunk_file_worker(job):
+
+    checksum, file_path, hash_name, buffer_size, average_size = job
+
+    try:
+        chunks = list(compute_chunks_for_file(file_path, hashlib.new(hash_name),
+                                              buffer_size, average_size))
+
+    except OSError:
+        chunks = None
+
+    return checksum, chunks
+
+
+def _scan_shard_worker(job):
+
+    # Catalog one subtree into its own shard database
+
+    search_dir, database, hash_name, settings = job
+
+    catalog_properties = CatalogProperties()
+    for name, value in settings.items():
+        setattr(catalog_properties, name, value)
+    catalog_properties.search_dir = search_dir
+    catalog_properties.database = database
+    catalog_properties.hash_function = hashlib.new(hash_name)
+
+    file_catalog = FileCatalog(catalog_properties)
+    file_catalog.connection.close()
+    if file_catalog.previous_connection is not None:
+        file_catalog.previous_connection.close()
+
+    return search_dir, database, len(file_catalog)
+
+
+def extract_office_metadata(file_path):
+
+    # Read the core and extended properties of an Office Open XML
+    # document (docx, xlsx, pptx) from the zip container.
+
+    import zipfile
+    import xml.etree.ElementTree as ET
+
+    ns = {'cp': 'http://schemas.openxmlformats.org/package/2006/metadata/core-properties',
+          'dc': 'http://purl.org/dc/elements/1.1/',
+          'dcterms': 'http://purl.org/dc/terms/',
+          'ep': 'http://schemas.openxmlformats.org/officeDocument/2006/extended-properties',
+          'ss': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+
+    d = {}
+
+    with zipfile.ZipFile(file_path) as z:
+        names = set(z.namelist())
+
+        if 'docProps/core.xml' in names:
+            core = ET.fromstring(z.read('docProps/core.xml'))
+            for key, tag in [('title', 'dc:title'), ('author', 'dc:creator'),
+                             ('last_modified_by', 'cp:lastModifiedBy'),
+                             ('created', 'dcterms:created'),
+                             ('modified', 'dcterms:modified')]:
+                element = core.find(tag, ns)
+                if element is not None and element.text:
+                    d[key] = element.text
+
+        if 'docProps/app.xml' in names:
+            app = ET.fromstring(z.read('docProps/app.xml'))
+            for tag in ['ep:Pages', 'ep:Slides']:
+                element = app.find(tag, ns)
+                if element is not None and element.text:
+                    d['pages'] = int(element.text)
+
+        if 'xl/workbook.xml' in names:
+            workbook = ET.fromstring(z.read('xl/workbook.xml'))
+            d['sheets'] = len(workbook.findall('ss:sheets/ss:sheet', ns))
+
+    return d
+
+
+# Bytes read from each end of a PDF when its objects cannot be found
+# through the cross-reference table
+_PDF_SCAN_SIZE = 1 << 20
+
+
+def _pdf_xref(f, offset):
+
+    # Follow the cross-reference tables from offset back through /Prev
+    # and return (trailers, sections), newest first. sections is a list
+    # of (first object number, count, file offset of the entries).
+    # Cross-reference streams are compressed and are not parsed.
+
+    trailers = []
+    sections = []
+    seen = set()
+
+    while offset is not None and offset not in seen:
+        seen.add(offset)
+        f.seek(offset)
+        if f.readline().strip() != b'xref':
+            break
+
+        while True:
+            position = f.tell()
+            line = f.readline().split()
+            if len(line) != 2 or not all(s.isdigit() for s in line):
+                break
+            sections.append((int(line[0]), int(line[1]), f.tell()))
+            f.seek(f.tell() + int(line[1]) * 20)
+
+        f.seek(position)
+        trailer = f.read(4096).split(b'startxref')[0]
+        trailers.append(trailer)
+        match = re.search(rb'/Prev\s+(\d+)', trailer)
+        offset = int(match.group(1)) if match else None
+
+    return trailers, sections
+
+
+def _pdf_object(f, sections, regions, number):
+
+    # Return the body of an indirect object, located through the
+    # cross-reference entries when it has one and by searching the
+    # scanned regions otherwise, or None
+
+    for first, count, entries in sections:
+        if first <= number < first + count:
+            f.seek(entries + (number - first) * 20)
+            entry = f.read(20)
+            if entry[17:18] != b'n':
+                break
+            f.seek(int(entry[:10]))
+            data = f.read(4096)
+            if re.match(rb'\s*%d\s+\d+\s+obj' % number, data):
+                return data.split(b'endobj')[0]
+            break
+
+    for region in regions:
+        matches = list(re.finditer(rb'(?<!\d)%d\s+\d+\s+obj(.*?)endobj' % number, region, re.S))
+        if matches:
+            return matches[-1].group(1)
+
+    return None
+
+
+def extract_pdf_metadata(file_path):
+
+    # Read the document information dictionary and the page count of a
+    # PDF. Only the ends of the file are read: the trailer names the
+    # catalog and information objects, which are found through the
+    # cross-reference table, and the page count is the /Count of the
+    # page tree root. Values inside compressed object streams are not
+    # visible to this simple reader.
+
+    with open(file_path, 'rb') as f:
+        head = f.read(_PDF_SCAN_SIZE)
+        if not head.startswith(b'%PDF'):
+            raise InputError('Not a PDF file: {}'.format(file_path))
+
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(size - _PDF_SCAN_SIZE, len(head)))
+        tail = f.read()
+        regions = [tail, head] if tail else [head]
+        end = tail or head
+
+        matches = re.findall(rb'startxref\s+(\d+)', end)
+        trailers, sections = _pdf_xref(f, int(matches[-1]) if matches else None)
+
+        # Without a cross-reference table the last trailer or
+        # cross-reference stream dictionary in the file is used
+        trailers.append(end)
+
+        def reference(key):
+            for trailer in trailers:
+                matches = re.findall(rb'/' + key + rb'\s+(\d+)\s+\d+\s+R', trailer)
+                if matches:
+                    return int(matches[-1])
+            return None
+
+        d = {'pages': None}
+
+        root = reference(b'Root')
+        catalog = _pdf_object(f, sections, regions, root) if root is not None else None
+        match = catalog and re.search(rb'/Pages\s+(\d+)\s+\d+\s+R', catalog)
+        if match:
+            pages = _pdf_object(f, sections, regions, int(match.group(1)))
+            match = pages and re.search(rb'/Count\s+(\d+)', pages)
+            if match:
+                d['pages'] = int(match.group(1))
+
+        info = reference(b'Info')
+        info = _pdf_object(f, sections, regions, info) if info is not None else None
+
+    for key, name in [('title', b'Title'), ('author', b'Author'),
+                      ('created', b'CreationDate'), ('modified', b'ModDate')]:
+        match = info and re.search(rb'/' + name + rb'\s*\(((?:\\.|[^\\)])*)\)', info)
+        if match:
+            d[key] = re.sub(rb'\\([()\\])', rb'\1', match.group(1)).decode('latin-1')
+
+    return d
+
+
+# Metadata extractors by lowercase file extension. Each extractor
+# takes a file path and returns a dictionary with any of the keys
+# title, author, last_modified_by, created, modified, pages and sheets.
+# Add an entry to extract metadata from another file type.
+METADATA_EXTRACTORS = {'.docx': extract_office_metadata,
+                       '.docm': extract_office_metadata,
+                       '.xlsx': extract_office_metadata,
+                       '.xlsm': extract_office_metadata,
+                       '.pptx': extract_office_metadata,
+                       '.pdf': extract_pdf_metadata}
+
+
+def extract_metadata_for_file(file_path):
+
+    # Return the metadata for a file with an error value of 1 if the
+    # extractor failed. Used by the worker pool.
+
+    extension = os.path.splitext(file_path)[1].lower()
+
+    try:
+        d = METADATA_EXTRACTORS[extension](file_path)
+        d['error'] = 0
+
+    except Exception:
+        d = {'error': 1}
+
+    return d
+
+
+def long_file_name(fname):
+
+    # Create the Windows long file name representation for local and
+    # network locations.
+
+    if(fname.lower().startswith('c:')):
+
+        long_name = r'\\?\{}'.format(os.path.normpath(fname))
+
+    elif(fname.startswith(r'\\')):
+
+        long_name = r'\\?\UNC{}'.format(fname[1:])
+
+    return long_name
+
+
+def get_human_readable(size, precision=0):
+
+    # Take bytes as input and return human readable string to
+    # specified precision.
+
+    suffixes = ['B', 'KB', 'MB', 'GB', 'TB']
+    suffixIndex = 0
+
+    while size > 1024 and suffixIndex < 4:
+        suffixIndex += 1  # increment the index of the suffix
+        size = size/1024.0  # apply the division
+
+    return "%.*f%s"%(int(precision), size, suffixes[suffixIndex])
+
+
+class MsgFile(object):
+    """MsgFile reads the metadata of an Outlook .msg file.
+
+    Outlook .msg files are OLE compound files. MsgFile reads the
+    compound file structure directly so that no Outlook installation
+    or COM interface is required. Only the top-level message
+    properties are parsed.
+
+    Args:
+        path (str): A path to the .msg file. If the file is not a
+            compound file, an InputError is thrown.
+
+    Attributes:
+        path (str): A path to the .msg file.
+        streams (dict): Stream name to bytes for the top-level streams.
+        storages (list of str): Names of the top-level storages.
+
+    """
+
+    signature = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+    # MAPI property ids
+    subject = 0x0037
+    sender_name = 0x0C1A
+    display_to = 0x0E04
+    display_cc = 0x0E03
+    client_submit_time = 0x0039
+
+    def __init__(self, path):
+
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self._data = f.read()
+
+        if self._data[:8] != self.signature:
+            raise InputError('Not an OLE compound file: {}'.format(path))
+
+        self.read_header()
+        self.read_fat()
+        self.read_directory()
+
+    def read_header(self):
+        (self.sector_size, self.mini_sector_size) = [
+            1 << s for s in struct.unpack_from('<HH', self._data, 0x1E)]
+        (n_fat, self.first_dir_sector, _, self.mini_cutoff,
+         self.first_mini_fat_sector, n_mini_fat,
+         self.first_difat_sector, n_difat) = struct.unpack_from('<8I', self._data, 0x2C)
+
+        # The first 109 FAT sector locations are in the header, the
+        # remainder are in a chain of DIFAT sectors
+        fat_sectors = list(struct.unpack_from('<109I', self._data, 0x4C))
+        sector = self.first_difat_sector
+        per_sector = self.sector_size // 4 - 1
+        for ii in range(n_difat):
+            entries = struct.unpack_from('<{}I'.format(per_sector + 1),
+                                         self._data, self.sector_offset(sector))
+            fat_sectors += entries[:per_sector]
+            sector = entries[per_sector]
+
+        self.fat_sectors = fat_sectors[:n_fat]
+
+    def sector_offset(self, sector):
+        return (sector + 1) * self.sector_size
+
+    def read_fat(self):
+        n = self.sector_size // 4
+        self.fat = []
+        for sector in self.fat_sectors:
+            self.fat += struct.unpack_from('<{}I'.format(n), self._data,
+                                           self.sector_offset(sector))
+
+        mini_fat = self.read_chain(self.first_mini_fat_sector)
+        self.mini_fat = struct.unpack('<{}I'.format(len(mini_fat) // 4), mini_fat)
+
+    def read_chain(self, sector, size=None):
+        parts = []
+        seen = set()
+        while sector < len(self.fat) and sector not in seen:
+            seen.add(sector)
+            offset = self.sector_offset(sector)
+            parts.append(self._data[offset:offset + self.sector_size])
+            sector = self.fat[sector]
+
+        data = b''.join(parts)
+        return data if size is None else data[:size]
+
+    def read_mini_chain(self, sector, size):
+        parts = []
+        seen = set()
+        while sector < len(self.mini_fat) and sector not in seen:
+            seen.add(sector)
+            offset = sector * self.mini_sector_size
+            parts.append(self._mini_stream[offset:offset + self.mini_sector_size])
+            sector = self.mini_fat[sector]
+
+        return b''.join(parts)[:size]
+
+    def read_directory(self):
+        data = self.read_chain(self.first_dir_sector)
+        entries = []
+        for offset in range(0, len(data) - 127, 128):
+            name_length, entry_type = struct.unpack_from('<HB', data, offset + 64)
+            left, right, child = struct.unpack_from('<3I', data, offset + 68)
+            start, size = struct.unpack_from('<IQ', data, offset + 116)
+            name = data[offset:offset + max(name_length - 2, 0)].decode('utf-16-le', 'replace')
+            entries.append((name, entry_type, left, right, child, start, size))
+
+        root = entries[0]
+        if self.sector_size == 512:
+            # Version 3 files only use the low 32 bits of the size
+            root = root[:6] + (root[6] & 0xFFFFFFFF,)
+        self._mini_stream = self.read_chain(root[5], root[6])
+
+        self.streams = {}
+        self.storages = []
+
+        # Children of a storage are kept in a red-black tree linked by
+        # the left and right sibling ids
+        stack = [root[4]]
+        while stack:
+            sid = stack.pop()
+            if sid >= len(entries):
+                continue
+            name, entry_type, left, right, child, start, size = entries[sid]
+            stack += [left, right]
+
+            if entry_type == 1:
+                self.storages.append(name)
+
+            elif entry_type == 2:
+                if self.sector_size == 512:
+                    size &= 0xFFFFFFFF
+                if size < self.mini_cutoff:
+                    self.streams[name] = self.read_mini_chain(start, size)
+                else:
+                    self.streams[name] = self.read_chain(start, size)
+
+        del self._data
+
+    def get_string(self, prop_id):
+        """Return a string property, or None if it is not present."""
+        name = '__substg1.0_{:04X}'.format(prop_id)
+
+        value = self.streams.get(name + '001F')
+        if value is not None:
+            return value.decode('utf-16-le', 'replace').rstrip('\x00')
+
+        value = self.streams.get(name + '001E')
+        if value is not None:
+            return value.decode('cp1252', 'replace').rstrip('\x00')
+
+        return None
+
+    def get_time(self, prop_id):
+        """Return a PT_SYSTIME property as a naive datetime in local
+        time, as Outlook shows it, or None."""
+        data = self.streams.get('__properties_version1.0', b'')
+
+        # The top-level message has a 32 byte header followed by 16
+        # byte fixed-length property entries
+        for offset in range(32, len(data) - 15, 16):
+            prop_type, pid, flags, value = struct.unpack_from('<HHIQ', data, offset)
+            if pid == prop_id and prop_type == 0x0040:
+                utc = (datetime.datetime(1601, 1, 1, tzinfo=datetime.timezone.utc)
+                       + datetime.timedelta(microseconds=value // 10))
+                try:
+                    return utc.astimezone().replace(tzinfo=None)
+
+                except (OverflowError, OSError):
+                    # Dates outside the platform's local time range
+                    return utc.replace(tzinfo=None)
+
+        return None
+
+    @property
+    def attachment_count(self):
+        return len([s for s in self.storages if s.startswith('__attach_version1.0_')])
+
+    def as_dict(self):
+        return {'Subject': self.get_string(self.subject),
+                'From': self.get_string(self.sender_name),
+                'To': self.get_string(self.display_to),
+                'CC': self.get_string(self.display_cc),
+                'Sent Date': self.get_time(self.client_submit_time),
+                'Number of Attachments': self.attachment_count}
+
+
+def parse_msg_file(file_path):
+
+    # Return the message metadata for a .msg file. The error value is
+    # a bitfield: 1 if the file could not be opened, 2 if the subject,
+    # attachments or sent date could not be read, and 4 if the sender
+    # or recipients could not be read. Used by the worker pool.
+
+    d = {'error': 0}
+
+    try:
+        msg = MsgFile(file_path)
+
+    except Exception:
+        d['error'] += 1
+        return d
+
+    try:
+        d['Subject'] = msg.get_string(msg.subject)
+        try:
+            d['From'] = msg.get_string(msg.sender_name)
+            d['To'] = msg.get_string(msg.display_to)
+            d['CC'] = msg.get_string(msg.display_cc)
+        except Exception:
+            d['error'] += 4
+        d['Number of Attachments'] = msg.attachment_count
+        d['Sent Date'] = msg.get_time(msg.client_submit_time)
+
+    except Exception:
+        d['error'] += 2
+
+    return d
+
+
+def email_catalog(emails, workers=None):
+
+    # Parse the .msg files in parallel. Entries in emails are
+    # dictionaries including the appropriate data for each email.
+
+    import multiprocessing
+
+    with multiprocessing.Pool(workers) as pool:
+        parsed = pool.map(parse_msg_file, [e['Link Path'] for e in emails])
+
+    catalog = []
+
+    for e, msg in zip(emails, parsed):
+
+        d = {'Filename': e['Filename'],
+             'Link Path': e['Link Path'],
+             'Directory': e['Directory'],
+             'File Size': e['File Size'],
+             'File Path': e['File Path'],
+             'File Link': e['File Link'],
+             'Directory Link': e['Directory Link']}
+
+        d.update(msg)
 
         # Append dictionary to catalog list
         catalog.append(d)
 
+    import pandas as pd
+
     EC = pd.DataFrame(catalog)
 
     # Order columns
@@ -835,25 +4149,24 @@ def email_catalog(emails):
             'Subject', 'Number of Attachments', 'File Link', 'Directory Link',
             'Link Path', 'Directory', 'error']
 
-    EC = EC[cols]
+    EC = EC.reindex(columns=cols)
 
     return EC
 
 
-def copy_specific_files(df, dest_dir, allow_existing_dir=False):
+def copy_specific_files(df, dest_dir, allow_existing_dir=False, workers=8):
 
     """
     copy_specific_files(df, dest_dir)
 
     Use to copy files containted in a dataframe to a destination
     directory. The dataframe must contain a column 'File Path' that
-    corresponds to the absolute path location of the file. A batch file is
-    created and robocopy is used to copy the files.  
+    corresponds to the absolute path location of the file. The
+    filename is prefixed with the name of the 'Link Path' to prevent
+    name collisions. Files are copied by a pool of threads.
     """
 
-    
-    if not platform.system() == 'Windows':
-        raise OSError
+    import concurrent.futures
 
     if not allow_existing_dir:
         if os.path.isdir(dest_dir):
@@ -867,49 +4180,36 @@ def copy_specific_files(df, dest_dir, allow_existing_dir=False):
         else:
             os.mkdir(dest_dir)
 
-    batch_file = 'run.bat'
+    jobs = []
 
-    with open(batch_file, 'w') as bfile:
+    for ii, row in df.iterrows():
+        fp = row['File Path']
+        lp = row['Link Path']
 
-        bfile.write('ECHO OFF\n')
-
-        for ii, row in df.iterrows():
-            fp = row['File Path']
-            lp = row['Link Path']
-            
-            if os.path.isfile(fp):
-                path, fname = os.path.split(fp)
-
-                # Add a unique identifier to the filename to prevent name collisions
-                prefix = os.path.splitext(os.path.basename(lp))[0]
-                dest_fname = prefix + '--' + fname
-
-                if os.path.isfile(os.path.join(dest_dir, dest_fname)):
-                    #print('Destination name collision.\n{}\n'.format(fp))
-                    pass
+        if os.path.isfile(fp):
+            fname = os.path.basename(fp)
 
-                else:
-                    bfile.write('ROBOCOPY "{}" "{}" "{}"\n'.format(path, dest_dir, fname))
-                    bfile.write('RENAME "{}" "{}"\n'.format(os.path.join(dest_dir, fname), dest_fname))
+            # Add a unique identifier to the filename to prevent name collisions
+            prefix = os.path.splitext(os.path.basename(lp))[0]
+            dest_fname = prefix + '--' + fname
 
-            else:
-                print('Skipping file, does not exist.\n{}\n'.format(fp))
+            if not os.path.isfile(os.path.join(dest_dir, dest_fname)):
+                jobs.append((fp, os.path.join(dest_dir, dest_fname)))
 
+        else:
+            print('Skipping file, does not exist.\n{}\n'.format(fp))
 
     try:
-        os.system(batch_file)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            list(executor.map(lambda job: shutil.copy2(*job), jobs))
 
-    except:
-        # Batch file did not run correctly.
+    except OSError:
+        # Copy did not complete correctly.
         return -2
 
-    finally:
-        os.remove(batch_file)
-
     return 1
 
 
-    
 def OSX_links(files):
 
     out_files = []
@@ -932,6 +4232,7 @@ def parse_arugments():
     parser.add_argument('-s', '--search-dir', type=str)
     parser.add_argument('-b', '--base-dir', type=str)
     parser.add_argument('-g', '--session-id', type=str)
+    parser.add_argument('--resume', type=str, metavar='SESSION_ID')
     parser.add_argument('-d', '--database', type=str)
     parser.add_argument('-e', '--existing-database', type=str)
     parser.add_argument('-o', '--output', action='store_true', default=False)
@@ -946,6 +4247,20 @@ def parse_arugments():
     parser.add_argument('-v', '--verbose', action='store_true', default=False)
     parser.add_argument('--do-not-check-existing-file-paths', action='store_true', default=False)
     parser.add_argument('--do-not-check-file-contents', action='store_true', default=False)
+    parser.add_argument('--duplicate-directories', action='store_true', default=False)
+    parser.add_argument('--chunk-index', action='store_true', default=False)
+    parser.add_argument('--chunk-size', type=int)
+    parser.add_argument('--near-duplicates', type=float)
+    parser.add_argument('--emails', action='store_true', default=False)
+    parser.add_argument('--extract-metadata', action='store_true', default=False)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--canonical', choices=['shortest', 'path'])
+    parser.add_argument('--async-concurrency', type=int)
+    parser.add_argument('--parallel', action='store_true', default=False)
+    parser.add_argument('--estimate', type=int, nargs='?', const=200, metavar='PROBES')
+    parser.add_argument('--diff', nargs=2, metavar=('OLD_SESSION', 'NEW_SESSION'))
+    parser.add_argument('-w', '--watch', action='store_true', default=False)
+    parser.add_argument('--watch-interval', type=float, default=2.0)
 
     return parser.parse_args()
 
@@ -953,7 +4268,42 @@ def parse_arugments():
 def main(args=None):
 
     CP = CatalogProperties(args)
-    FC = FileCatalog(CP)
+
+    if args and args.estimate is not None:
+        print(CatalogEstimator(CP, probes=args.estimate).report())
+        return
+
+    if args and args.diff:
+        print(SessionDiff(CP.database, *args.diff).report())
+        return
+
+    if CP.parallel:
+        FC = ShardedCatalog(CP, CP.workers).run()
+    else:
+        FC = FileCatalog(CP)
+
+    if args and args.duplicate_directories:
+        for tree_hash, size, file_count, rel_paths in FC.duplicate_directories():
+            print('{} files, {} each:'.format(file_count, get_human_readable(size)))
+            for rel_path in rel_paths:
+                print('    {}'.format(rel_path))
+
+    if args and args.copy:
+        summary = copy_catalog(CP.database, args.copy_dir, CP.session_id,
+                               workers=CP.workers or 8, allow_overwrite=args.allow_overwrite,
+                               verbose=CP.verbose)
+        print('Copy: {}'.format(', '.join('{} {}'.format(v, k) for k, v in sorted(summary.items()))))
+
+    if args and args.near_duplicates is not None:
+        paths = dict((f.checksum, f.relative_path) for f in FC.files)
+        for checksum_a, checksum_b, shared, ratio in FC.near_duplicates(args.near_duplicates):
+            print('{:.1%} ({} shared):'.format(ratio, get_human_readable(shared)))
+            print('    {}'.format(paths.get(checksum_a, checksum_a)))
+            print('    {}'.format(paths.get(checksum_b, checksum_b)))
+
+    if args and args.watch:
+        print('Watching {}...'.format(CP.search_dir))
+        CatalogWatcher(FC, interval=args.watch_interval).run()
 
     
 if __name__ == '__main__':
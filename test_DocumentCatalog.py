@@ -1,13 +1,33 @@
 import unittest
+from unittest import mock
 
 import DocumentCatalog as DC
 import os
 import hashlib
+import datetime
+import random
+import shutil
+import filecmp
+import tempfile
+import subprocess
+import sys
+import sqlite3
 
 test_dir = os.path.join(os.getcwd(), 'test')
 CP = DC.CatalogProperties()
 CP.search_dirs = [test_dir]
 
+
+def temporary_catalog_properties(search_dir, session_id):
+    tmp_dir = tempfile.mkdtemp()
+    CP_tmp = DC.CatalogProperties()
+    CP_tmp.search_dir = search_dir
+    CP_tmp.base_dir = search_dir
+    CP_tmp.database = os.path.join(tmp_dir, 'document_catalog.db')
+    CP_tmp.session_id = session_id
+    return CP_tmp
+
+
 class TestDC(unittest.TestCase):
 
     def test_search_in_new_directory(self):
@@ -31,10 +51,19 @@ class TestDC(unittest.TestCase):
 
 
     def test_duplicate_detection(self):
-        FC = DC.FileCatalog(CP)
+        FC = DC.FileCatalog(temporary_catalog_properties(test_dir, 'duplicates'))
         df = FC.as_df()
         self.assertEqual(len(df.loc[df['Duplicate']==False]), 5)
 
+        # Flags of another session with the same files are not used
+        FC.cursor.execute('''
+        INSERT INTO file_entries (dir_id, filename, size, session_id, file_key, duplicate)
+        SELECT dir_id, filename, size, 'other', file_key, duplicate FROM file_entries;
+        ''')
+        FC.cursor.execute("UPDATE file_entries SET duplicate = 0 WHERE session_id = 'duplicates'")
+        df = FC.as_df()
+        self.assertEqual(len(df.loc[df['Duplicate']==False]), 9)
+
 
     def test_checksum(self):
         h = hashlib.sha1()
@@ -45,5 +74,606 @@ class TestDC(unittest.TestCase):
         chksum2 = DC.compute_checksum_for_file(fp2, h, buffer_size)
         self.assertEqual(chksum1, chksum2)
 
+    def test_duplicate_directories(self):
+        search_dir = os.path.join(tempfile.mkdtemp(), 'search')
+        shutil.copytree(os.path.join(test_dir, 'sub_dir'), os.path.join(search_dir, 'a'))
+        shutil.copytree(os.path.join(test_dir, 'sub_dir'), os.path.join(search_dir, 'b', 'c'))
+        FC4 = DC.FileCatalog(temporary_catalog_properties(search_dir, 'dirs'))
+        groups = FC4.duplicate_directories()
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(sorted(groups[0][3]), ['a', os.path.join('b', 'c')])
+        self.assertEqual(groups[0][2], 3)
+
+        # a and b are copies, c and d are copies, and all four contain
+        # the same subtree x
+        search_dir = os.path.join(tempfile.mkdtemp(), 'search')
+        for parent in ('a', 'b', 'c', 'd'):
+            shutil.copytree(os.path.join(test_dir, 'sub_dir'), os.path.join(search_dir, parent, 'x'))
+        for parent in ('c', 'd'):
+            shutil.copy(os.path.join(test_dir, 'text1.txt'), os.path.join(search_dir, parent))
+        FC4 = DC.FileCatalog(temporary_catalog_properties(search_dir, 'nested'))
+        groups = sorted(sorted(g[3]) for g in FC4.duplicate_directories())
+        self.assertEqual(groups, [['a', 'b'], [os.path.join(p, 'x') for p in 'abcd'], ['c', 'd']])
+
+    def test_walk_stats_each_file_once(self):
+        CP4 = temporary_catalog_properties(test_dir, 'stats')
+        with mock.patch.object(DC.os, 'stat', wraps=os.stat) as os_stat:
+            DC.FileCatalog(CP4)
+        scanned = [c for c in os_stat.call_args_list if c.args[0].startswith(test_dir)]
+        self.assertEqual(len(scanned), 9)
+
+    def test_rescan_reads_matching_session(self):
+        # A file changed in one session and restored in the next takes
+        # its checksum from the session whose listing matches
+        search_dir = tempfile.mkdtemp()
+        path = os.path.join(search_dir, 'a.txt')
+        with open(path, 'w') as f:
+            f.write('first')
+        stat = os.stat(path)
+        CP5 = temporary_catalog_properties(search_dir, 's1')
+        DC.FileCatalog(CP5)
+
+        with open(path, 'w') as f:
+            f.write('other')
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 10))
+        CP5.session_id = 's2'
+        with mock.patch('builtins.input', return_value='y'):
+            DC.FileCatalog(CP5)
+
+        with open(path, 'w') as f:
+            f.write('first')
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        CP5.session_id = 's3'
+        with mock.patch('builtins.input', return_value='y'), \
+                mock.patch.object(DC, 'compute_checksum_for_file') as compute:
+            FC5 = DC.FileCatalog(CP5)
+        compute.assert_not_called()
+        FC5.cursor.execute('SELECT session_id, checksum FROM files ORDER BY session_id')
+        first = hashlib.sha1(b'first').hexdigest()
+        self.assertEqual(FC5.cursor.fetchall(), [('s1', first), ('s2', hashlib.sha1(b'other').hexdigest()),
+                                                 ('s3', first)])
+
+    def test_near_duplicates(self):
+        search_dir = tempfile.mkdtemp()
+        data = random.Random(0).randbytes(200000)
+        with open(os.path.join(search_dir, 'v1.bin'), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(search_dir, 'v2.bin'), 'wb') as f:
+            f.write(data[:50000] + b'edit' + data[50000:])
+        CP5 = temporary_catalog_properties(search_dir, 'chunks')
+        CP5.chunk_index = True
+        FC5 = DC.FileCatalog(CP5)
+        pairs = FC5.near_duplicates(0.8)
+        self.assertEqual(len(pairs), 1)
+        self.assertLess(pairs[0][3], 1.0)
+        self.assertEqual(FC5.near_duplicates(0.8, max_sharing=1), [])
+
+        # A third version cataloged in another session is not paired
+        # with the files of the first
+        other_dir = tempfile.mkdtemp()
+        with open(os.path.join(other_dir, 'v3.bin'), 'wb') as f:
+            f.write(data[:150000] + b'edit' + data[150000:])
+        CP5b = temporary_catalog_properties(other_dir, 'chunks2')
+        CP5b.database = CP5.database
+        CP5b.chunk_index = True
+        with mock.patch('builtins.input', return_value='y'):
+            DC.FileCatalog(CP5b)
+        self.assertEqual(FC5.near_duplicates(0.8), pairs)
+        self.assertEqual(len(FC5.shared_byte_ratios()), 2)
+
+        # The numpy and pure Python rolling hashes cut the same chunks
+        path = os.path.join(search_dir, 'v2.bin')
+        chunks = list(DC.compute_chunks_for_file(path, hashlib.sha1(), 4096, 1024))
+        with mock.patch.dict(sys.modules, {'numpy': None}):
+            self.assertEqual(list(DC.compute_chunks_for_file(path, hashlib.sha1(), 4096, 1024)), chunks)
+
+    def test_msg_file(self):
+        msg = DC.MsgFile(os.path.join(test_dir, 'email02.msg')).as_dict()
+        self.assertEqual(msg['Subject'], 'Email Security Digest: 5 New Messages ')
+        self.assertEqual(msg['From'], 'proofpoint-pps@ppops.net')
+        self.assertEqual(msg['To'], 'Charles DeVore')
+        self.assertEqual(msg['Number of Attachments'], 0)
+        # Sent Date is in local time like Outlook's SentOn
+        sent = datetime.datetime(2018, 6, 16, 11, 2, 20, tzinfo=datetime.timezone.utc)
+        self.assertEqual(msg['Sent Date'], sent.astimezone().replace(tzinfo=None))
+
+        self.assertEqual(DC.parse_msg_file(os.path.join(test_dir, 'text1.txt')), {'error': 1})
+        with mock.patch.object(DC.MsgFile, 'get_string', side_effect=['Subject', ValueError]):
+            d = DC.parse_msg_file(os.path.join(test_dir, 'email02.msg'))
+        self.assertEqual((d['error'], d['Subject'], d['Number of Attachments']), (4, 'Subject', 0))
+
+    def test_catalog_emails(self):
+        CP6 = temporary_catalog_properties(test_dir, 'emails')
+        CP6.emails = True
+        FC6 = DC.FileCatalog(CP6)
+        rows = FC6.cursor.execute('SELECT subject, error FROM emails').fetchall()
+        # Four .msg files with two distinct checksums
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(all(error == 0 for subject, error in rows))
+
+    def test_extract_file_metadata(self):
+        CP7 = temporary_catalog_properties(test_dir, 'metadata')
+        CP7.extract_metadata = True
+        FC7 = DC.FileCatalog(CP7)
+        FC7.cursor.execute('''
+        SELECT m.author, m.sheets, m.error FROM file_metadata m
+        INNER JOIN files f ON f.checksum = m.checksum
+        WHERE f.filename = 'this is an Excel spreadsheet.xlsx';
+        ''')
+        self.assertEqual(FC7.cursor.fetchone(), ('Charles DeVore', 1, 0))
+
+        # Rows with an error are retried on the next run
+        FC7.cursor.execute('UPDATE file_metadata SET author = NULL, error = 1')
+        FC7.connection.commit()
+        FC7.extract_file_metadata()
+        FC7.cursor.execute('SELECT author FROM file_metadata WHERE author IS NOT NULL')
+        self.assertEqual(FC7.cursor.fetchall(), [('Charles DeVore',)])
+
+    def test_extract_pdf_metadata(self):
+        # Three pages, an information dictionary replaced by an
+        # incremental update, and padding so the objects are only found
+        # through the cross-reference tables
+        objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+                   b'<< /Type /Pages /Count 3 /Kids [3 0 R 4 0 R 5 0 R] >>',
+                   b'<< /Type /Page /Parent 2 0 R >>',
+                   b'<< /Type /Page /Parent 2 0 R >>',
+                   b'<< /Type /Page /Parent 2 0 R >>',
+                   b'<< /Title (Old) /Author (Someone \\(A\\)) >>']
+        data = b'%PDF-1.4\n'
+        offsets = []
+        for ii, body in enumerate(objects, 1):
+            data += b'%' * 5000 + b'\n'
+            offsets.append(len(data))
+            data += b'%d 0 obj\n%s\nendobj\n' % (ii, body)
+        xref = len(data)
+        data += b'xref\n0 7\n0000000000 65535 f\r\n'
+        data += b''.join(b'%010d 00000 n\r\n' % o for o in offsets)
+        data += b'trailer\n<< /Size 7 /Root 1 0 R /Info 6 0 R >>\nstartxref\n%d\n%%%%EOF\n' % xref
+        update = len(data)
+        data += b'7 0 obj\n<< /Title (New) >>\nendobj\n'
+        data += b'xref\n7 1\n%010d 00000 n\r\n' % update
+        data += b'trailer\n<< /Size 8 /Root 1 0 R /Info 7 0 R /Prev %d >>\n' % xref
+        data += b'startxref\n%d\n%%%%EOF\n' % (update + len(b'7 0 obj\n<< /Title (New) >>\nendobj\n'))
+        path = os.path.join(tempfile.mkdtemp(), 'document.pdf')
+        with open(path, 'wb') as f:
+            f.write(data)
+        with mock.patch.object(DC, '_PDF_SCAN_SIZE', 256):
+            self.assertEqual(DC.extract_pdf_metadata(path), {'pages': 3, 'title': 'New'})
+        objects_only = data[:xref]
+        with open(path, 'wb') as f:
+            f.write(objects_only + b'trailer\n<< /Root 1 0 R /Info 6 0 R >>\n%%EOF\n')
+        self.assertEqual(DC.extract_pdf_metadata(path),
+                         {'pages': 3, 'title': 'Old', 'author': 'Someone (A)'})
+
+    def test_catalog_query(self):
+        CP8 = temporary_catalog_properties(test_dir, 'query')
+        DC.FileCatalog(CP8)
+        query = DC.CatalogQuery(CP8.database)
+        self.assertEqual(len(list(query.by_extension('.msg'))), 4)
+        self.assertEqual(len(list(query.by_path_prefix('sub_dir'))), 3)
+        checksum = DC.compute_checksum_for_file(
+            os.path.join(test_dir, 'email02.msg'), hashlib.sha1(), 4096)
+        self.assertEqual(sorted(r.filename for r in query.by_checksum(checksum)),
+                         ['email02-renamed.msg', 'email02.msg'])
+        self.assertEqual(len(list(query.duplicate_groups())), 3)
+        query.close()
+
+        # A path with URI characters is opened as it is, without
+        # creating a database
+        database = os.path.join(tempfile.mkdtemp(), 'a#b?c', 'catalog.db')
+        os.makedirs(os.path.dirname(database))
+        shutil.copy(CP8.database, database)
+        query = DC.CatalogQuery(database)
+        self.assertEqual(len(list(query.by_extension('.msg'))), 4)
+        query.close()
+        self.assertEqual(os.listdir(os.path.dirname(os.path.dirname(database))), ['a#b?c'])
+
+    def test_copy_catalog(self):
+        CP9 = temporary_catalog_properties(test_dir, 'copy')
+        DC.FileCatalog(CP9)
+        dest_dir = os.path.join(tempfile.mkdtemp(), 'copy')
+        summary = DC.copy_catalog(CP9.database, dest_dir)
+        self.assertEqual(summary, {'copied': 5, 'linked': 4})
+        self.assertTrue(os.path.samefile(
+            os.path.join(dest_dir, 'email02.msg'),
+            os.path.join(dest_dir, 'sub_dir', 'email02-renamed.msg')))
+        # A second run finds everything already done
+        self.assertEqual(DC.copy_catalog(CP9.database, dest_dir), {'done': 9})
+
+        # With two scans of the same tree a session must be chosen, and
+        # each destination holds one session
+        CP9b = temporary_catalog_properties(test_dir, 'copy2')
+        CP9b.database = CP9.database
+        with mock.patch('builtins.input', return_value='y'):
+            DC.FileCatalog(CP9b)
+        other_dir = os.path.join(tempfile.mkdtemp(), 'copy')
+        self.assertRaises(DC.InputError, DC.copy_catalog, CP9.database, other_dir)
+        self.assertRaises(DC.InputError, DC.copy_catalog, CP9.database, dest_dir, 'copy2')
+        self.assertEqual(DC.copy_catalog(CP9.database, other_dir, 'copy2'), {'copied': 5, 'linked': 4})
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(other_dir)), 9)
+
+        # Files already in the destination are kept unless overwriting
+        # is allowed
+        third_dir = os.path.join(tempfile.mkdtemp(), 'copy')
+        os.makedirs(third_dir)
+        for name in ('text1.txt', 'email02.msg'):
+            with open(os.path.join(third_dir, name), 'w') as f:
+                f.write('keep')
+        summary = DC.copy_catalog(CP9.database, third_dir, 'copy2')
+        self.assertEqual(summary['failed'], 2)
+        with open(os.path.join(third_dir, 'text1.txt')) as f:
+            self.assertEqual(f.read(), 'keep')
+        summary = DC.copy_catalog(CP9.database, third_dir, 'copy2', allow_overwrite=True)
+        self.assertNotIn('failed', summary)
+        self.assertEqual(sum(summary.values()), 9)
+        self.assertTrue(filecmp.cmp(os.path.join(test_dir, 'text1.txt'), os.path.join(third_dir, 'text1.txt'),
+                                    shallow=False))
+
+        # Copying needs a destination
+        with mock.patch.object(sys, 'argv', ['DocumentCatalog.py', '-c']):
+            self.assertRaises(DC.InputError, DC.CatalogProperties, DC.parse_arugments())
+
+    def test_watch_polling(self):
+        search_dir = os.path.join(tempfile.mkdtemp(), 'search')
+        shutil.copytree(test_dir, search_dir)
+        FC10 = DC.FileCatalog(temporary_catalog_properties(search_dir, 'watch'))
+        watcher = DC.CatalogWatcher(FC10, interval=0, use_inotify=False)
+        os.remove(os.path.join(search_dir, 'email02.msg'))
+        with open(os.path.join(search_dir, 'text1.txt'), 'w') as f:
+            f.write('changed')
+        os.makedirs(os.path.join(search_dir, 'new'))
+        shutil.copy(os.path.join(test_dir, 'email02.msg'), os.path.join(search_dir, 'new'))
+        changes = watcher.refresh(watcher.wait_for_changes())
+        self.assertEqual(changes, {'deleted': 1, 'updated': 1, 'inserted': 1})
+        FC10.cursor.execute('SELECT rel_path, duplicate FROM files WHERE filename LIKE "email02%"')
+        self.assertEqual(sorted(FC10.cursor.fetchall()),
+                         [('new/email02.msg', 0), ('sub_dir/email02-renamed.msg', 1)])
+
+        # The directory rows match a fresh scan of the changed tree
+        shutil.rmtree(os.path.join(search_dir, 'sub_dir'))
+        watcher.refresh(watcher.wait_for_changes())
+        fresh = DC.FileCatalog(temporary_catalog_properties(search_dir, 'fresh'))
+        query = 'SELECT rel_path, parent, tree_hash, size, file_count FROM directories ORDER BY rel_path'
+        self.assertEqual(FC10.cursor.execute(query).fetchall(),
+                         fresh.cursor.execute(query).fetchall())
+
+    def test_watch_run_polling(self):
+        search_dir = os.path.join(tempfile.mkdtemp(), 'search')
+        shutil.copytree(test_dir, search_dir)
+        FC10 = DC.FileCatalog(temporary_catalog_properties(search_dir, 'run'))
+        watcher = DC.CatalogWatcher(FC10, interval=0.01, debounce=0.05, use_inotify=False)
+        os.remove(os.path.join(search_dir, 'text1.txt'))
+
+        events = []
+        wait_for_changes, refresh = watcher.wait_for_changes, watcher.refresh
+        watcher.wait_for_changes = lambda: events.append(wait_for_changes()) or events[-1]
+        watcher.refresh = lambda dirty: events.append(refresh(dirty))
+        watcher.run(duration=0.5)
+
+        # The change is reported by one poll and applied once the
+        # debounce expires, while the watcher keeps polling
+        changed = [e for e in events if e]
+        self.assertEqual(changed, [{search_dir}, {'deleted': 1}])
+        self.assertEqual(events[-1], set())
+
+    def test_resume_scan(self):
+        CP11 = temporary_catalog_properties(test_dir, 'resume')
+        CP11.database_row_buffer = 2
+        checksum = DC.compute_checksum_for_file
+        calls = []
+
+        def interrupted(*args):
+            calls.append(args[0])
+            if len(calls) == 8:
+                raise KeyboardInterrupt
+            return checksum(*args)
+
+        with mock.patch.object(DC, 'compute_checksum_for_file', interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                DC.FileCatalog(CP11)
+
+        CP11.resume = True
+        calls = []
+        with mock.patch.object(DC, 'compute_checksum_for_file',
+                               lambda *args: calls.append(args[0]) or checksum(*args)):
+            FC11 = DC.FileCatalog(CP11)
+
+        self.assertEqual(len(FC11), 9)
+        # The six files committed before the interruption are not read again
+        self.assertEqual(len(calls), 3)
+        FC11.cursor.execute('SELECT DISTINCT state FROM scan_progress WHERE session_id = ?', ('resume',))
+        self.assertEqual(FC11.cursor.fetchall(), [('done',)])
+
+    def test_resume_skips_symlinks_and_keeps_excludes(self):
+        search_dir = os.path.join(tempfile.mkdtemp(), 'search')
+        shutil.copytree(test_dir, search_dir)
+        os.makedirs(os.path.join(search_dir, 'other'))
+        shutil.copy(os.path.join(test_dir, 'text1.txt'), os.path.join(search_dir, 'other', 'copy.txt'))
+        os.symlink(os.path.join(search_dir, 'sub_dir'), os.path.join(search_dir, 'link'))
+        CP12 = temporary_catalog_properties(search_dir, 'links')
+        CP12.database_row_buffer = 1
+        CP12.exclude_dirs = ['sub_dir']
+        checksum = DC.compute_checksum_for_file
+        calls = []
+
+        def interrupted(*args):
+            calls.append(args[0])
+            if len(calls) == 7:
+                raise KeyboardInterrupt
+            return checksum(*args)
+
+        with mock.patch.object(DC, 'compute_checksum_for_file', interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                DC.FileCatalog(CP12)
+
+        # The resumed session excludes sub_dir without being told again
+        # and does not follow the link into it
+        CP12b = temporary_catalog_properties(search_dir, 'links')
+        CP12b.database = CP12.database
+        CP12b.resume = True
+        FC12 = DC.FileCatalog(CP12b)
+        self.assertEqual(CP12b.exclude_dirs, ['sub_dir'])
+        self.assertEqual(sorted(f.relative_path for f in FC12.files if os.sep in f.relative_path),
+                         [os.path.join('other', 'copy.txt')])
+
+    def test_async_scan_matches_sync(self):
+        search_dir = os.path.join(tempfile.mkdtemp(), 'search')
+        shutil.copytree(test_dir, search_dir)
+        for ii in range(3):
+            shutil.copytree(test_dir, os.path.join(search_dir, 'copy{}'.format(ii)))
+
+        def scan(concurrency, filesystem=None):
+            CP12 = temporary_catalog_properties(search_dir, 'async')
+            CP12.concurrency = concurrency
+            CP12.filesystem = filesystem
+            FC12 = DC.FileCatalog(CP12)
+            FC12.cursor.execute('SELECT rel_path, size, checksum, file_key FROM files ORDER BY rel_path')
+            files = FC12.cursor.fetchall()
+            FC12.cursor.execute('SELECT rel_path, tree_hash, size FROM directories ORDER BY rel_path')
+            return files, FC12.cursor.fetchall()
+
+        slow, fast = DC.LatencyFileSystem(0.005), DC.LatencyFileSystem(0.005)
+        sync_files, sync_dirs = scan(None)
+        slow_files, slow_dirs = scan(1, slow)
+        fast_files, fast_dirs = scan(16, fast)
+        self.assertEqual(len(sync_files), 36)
+        self.assertEqual(fast_files, sync_files)
+        self.assertEqual(fast_dirs, sync_dirs)
+        self.assertEqual(slow_files, sync_files)
+
+        # The calls overlap up to the concurrency limit
+        self.assertEqual(slow.max_in_flight, 1)
+        self.assertGreater(fast.max_in_flight, 1)
+        self.assertLessEqual(fast.max_in_flight, 16)
+
+    def test_estimate(self):
+        CP13 = DC.CatalogProperties()
+        CP13.search_dir = test_dir
+        result = DC.CatalogEstimator(CP13, probes=20, seed=0).run()
+        # Every descent sees the six top level files and the three in sub_dir
+        self.assertEqual(result['files'], (9, 9, 9))
+        self.assertEqual(result['directories'], (2, 2, 2))
+        self.assertEqual(result['extensions']['.msg'], 4)
+        self.assertGreater(result['hash_throughput'], 0)
+        self.assertRaises(DC.InputError, DC.CatalogEstimator, CP13, probes=0)
+
+    def test_compact_schema(self):
+        CP14 = temporary_catalog_properties(test_dir, 'compact')
+        FC14 = DC.FileCatalog(CP14)
+        FC14.cursor.execute('SELECT DISTINCT typeof(checksum), typeof(file_key), typeof(dir_id) FROM file_entries')
+        self.assertEqual(FC14.cursor.fetchall(), [('blob', 'blob', 'integer')])
+
+        # The files view has the rows of the original files table
+        columns = 'rel_path, filename, extension, size, human_readable, checksum, session_id, file_key'
+        FC14.cursor.execute('SELECT {} FROM files'.format(columns))
+        rows = sorted(FC14.cursor.fetchall())
+        self.assertEqual(rows, sorted(f.as_tuple() for f in FC14.files))
+
+        # A database with the original files table is converted when opened
+        legacy_db = os.path.join(tempfile.mkdtemp(), 'legacy.db')
+        connection = sqlite3.connect(legacy_db)
+        connection.execute('CREATE TABLE files (rel_path text, filename text, extension text, size integer, '
+                           'human_readable text, checksum text, session_id text, file_key text, '
+                           'PRIMARY KEY(file_key))')
+        connection.execute('CREATE TABLE catalog_properties (session_id text, search_dir text, base_dir text, '
+                           'hash_function text, hash_buffer_size integer, date text, PRIMARY KEY(session_id ASC))')
+        connection.executemany('INSERT INTO files VALUES (?,?,?,?,?,?,?,?)', rows)
+        # Rows written without a session ID
+        null_rows = [r[:6] + (None, r[7][::-1]) for r in rows]
+        connection.executemany('INSERT INTO files VALUES (?,?,?,?,?,?,?,?)', null_rows)
+        connection.execute('INSERT INTO catalog_properties VALUES (?,?,?,?,?,?)', CP14.as_tuple())
+        connection.commit()
+        connection.close()
+
+        search_dir = os.path.join(tempfile.mkdtemp(), 'search')
+        shutil.copytree(os.path.join(test_dir, 'sub_dir'), search_dir)
+        CP15 = temporary_catalog_properties(search_dir, 'converted')
+        CP15.database = legacy_db
+        with mock.patch('builtins.input', return_value='y'):
+            FC15 = DC.FileCatalog(CP15)
+        FC15.cursor.execute('SELECT {} FROM files WHERE session_id = ?'.format(columns), ('compact',))
+        self.assertEqual(sorted(FC15.cursor.fetchall()), rows)
+        FC15.cursor.execute('SELECT {} FROM files WHERE session_id IS NULL'.format(columns))
+        self.assertEqual(sorted(FC15.cursor.fetchall()), sorted(null_rows))
+        FC15.cursor.execute('SELECT COUNT(*), COUNT(DISTINCT rel_path) FROM directories WHERE session_id IS NULL')
+        count, distinct = FC15.cursor.fetchone()
+        self.assertEqual(count, distinct)
+        query = DC.CatalogQuery(legacy_db, 'converted')
+        self.assertEqual(len(list(query.files())), 3)
+        query.close()
+
+    def test_schema_migration(self):
+        # A version 2 database, with file_key unique across sessions
+        CP19 = temporary_catalog_properties(test_dir, 'version2')
+        DC.FileCatalog(CP19).connection.close()
+        connection = sqlite3.connect(CP19.database)
+        connection.executescript('''
+        DROP VIEW files;
+        ALTER TABLE file_entries RENAME TO new_file_entries;
+        CREATE TABLE file_entries (file_id integer PRIMARY KEY, dir_id integer, filename text,
+            extension text, size integer, checksum blob, session_id text, file_key blob UNIQUE,
+            duplicate integer);
+        INSERT INTO file_entries SELECT file_id, dir_id, filename, extension, size, checksum,
+            session_id, file_key, duplicate FROM new_file_entries;
+        DROP TABLE new_file_entries;
+        PRAGMA user_version = 2;
+        ''')
+        connection.close()
+
+        # It can be read as it is
+        query = DC.CatalogQuery(CP19.database, 'version2')
+        self.assertEqual(len(list(query.files())), 9)
+        query.close()
+
+        # and is converted when a new session is scanned into it
+        CP19.session_id = 'version3'
+        with mock.patch('builtins.input', return_value='y'):
+            FC19 = DC.FileCatalog(CP19)
+        self.assertEqual(DC.schema_version(FC19.connection), DC.SCHEMA_VERSION)
+        FC19.cursor.execute('SELECT session_id, COUNT(*), COUNT(canonical_id) FROM file_entries GROUP BY 1')
+        self.assertEqual(FC19.cursor.fetchall(), [('version2', 9, 0), ('version3', 9, 9)])
+        FC19.cursor.execute('SELECT COUNT(*) FROM files')
+        self.assertEqual(FC19.cursor.fetchone(), (18,))
+
+    def test_catalog_paths(self):
+        # A scan without a session ID gets one, so every directory has
+        # a single row
+        CP16 = temporary_catalog_properties(test_dir, None)
+        FC16 = DC.FileCatalog(CP16)
+        self.assertIsNotNone(CP16.session_id)
+        FC16.insert_directories({test_dir: DC.Directory(test_dir, [], CP16)})
+        FC16.cursor.execute('SELECT COUNT(*), COUNT(DISTINCT rel_path), COUNT(session_id) FROM directories')
+        self.assertEqual(FC16.cursor.fetchone(), (2, 2, 2))
+
+        # Relative paths are stored with '/' whatever the platform
+        with mock.patch.object(DC.os.path, 'sep', '\\'):
+            self.assertEqual(DC.to_catalog_path('a\\b\\c.txt'), 'a/b/c.txt')
+            self.assertEqual(DC.from_catalog_path('a/b/c.txt'), 'a\\b\\c.txt')
+
+    def test_update_duplicates(self):
+        search_dir = os.path.join(tempfile.mkdtemp(), 'search')
+        shutil.copytree(test_dir, search_dir)
+        shutil.copy(os.path.join(test_dir, 'email02.msg'), os.path.join(search_dir, 'z.msg'))
+        for canonical, expected in (('shortest', 'z.msg'), ('path', 'email02.msg')):
+            CP16 = temporary_catalog_properties(search_dir, canonical)
+            CP16.canonical = canonical
+            FC16 = DC.FileCatalog(CP16)
+            FC16.cursor.execute('SELECT SUM(duplicate), COUNT(*) FROM file_entries')
+            self.assertEqual(FC16.cursor.fetchone(), (5, 10))
+            FC16.cursor.execute('''
+            SELECT c.filename, SUM(f.duplicate), COUNT(*) FROM file_entries f
+            INNER JOIN file_entries c ON c.file_id = f.canonical_id
+            WHERE f.checksum = (SELECT checksum FROM file_entries WHERE filename = 'z.msg')
+            GROUP BY c.filename''')
+            self.assertEqual(FC16.cursor.fetchall(), [(expected, 2, 3)])
+
+        # Rows of a catalog written without a session ID
+        FC16.cursor.execute('UPDATE file_entries SET session_id = NULL, duplicate = NULL')
+        FC16.cursor.execute('UPDATE directories SET session_id = NULL')
+        CP16.session_id = None
+        FC16.update_duplicates()
+        FC16.cursor.execute('SELECT SUM(duplicate), COUNT(*) FROM file_entries')
+        self.assertEqual(FC16.cursor.fetchone(), (5, 10))
+
+        with mock.patch.object(DC.sqlite3, 'sqlite_version_info', (3, 32, 3)):
+            self.assertRaises(DC.InputError, DC.FileCatalog, temporary_catalog_properties(search_dir, 'old'))
+
+    def test_sharded_scan_matches_sync(self):
+        search_dir = os.path.join(tempfile.mkdtemp(), 'search')
+        shutil.copytree(test_dir, search_dir)
+        for ii in range(3):
+            shutil.copytree(test_dir, os.path.join(search_dir, 'copy{}'.format(ii)))
+
+        def scan(parallel):
+            CP17 = temporary_catalog_properties(search_dir, 'sharded')
+            if parallel:
+                FC17 = DC.ShardedCatalog(CP17, workers=2).run()
+            else:
+                FC17 = DC.FileCatalog(CP17)
+            FC17.cursor.execute('SELECT rel_path, size, checksum, file_key, duplicate FROM files ORDER BY rel_path')
+            files = FC17.cursor.fetchall()
+            FC17.cursor.execute('''SELECT rel_path, parent, tree_hash, listing_hash, size, file_count
+                                   FROM directories ORDER BY rel_path''')
+            return files, FC17.cursor.fetchall()
+
+        sync_files, sync_dirs = scan(False)
+        sharded_files, sharded_dirs = scan(True)
+        self.assertEqual(len(sync_files), 36)
+        self.assertEqual(sharded_files, sync_files)
+        self.assertEqual(sharded_dirs, sync_dirs)
+
+        # A worker reads the checksums of unchanged directories from the
+        # session database while writing its own shard
+        CP17 = temporary_catalog_properties(search_dir, 'first')
+        DC.FileCatalog(CP17)
+        settings = {'base_dir': search_dir, 'session_id': 'second', 'exclude_dirs': [],
+                    'previous_database': CP17.database}
+        shard = os.path.join(tempfile.mkdtemp(), 'shard.db')
+        with mock.patch.object(DC, 'compute_checksum_for_file') as compute:
+            result = DC._scan_shard_worker((os.path.join(search_dir, 'copy0'), shard, 'sha1', settings))
+        self.assertEqual(result[2], 9)
+        compute.assert_not_called()
+
+        # The shard databases are removed when the scan fails
+        CP17 = temporary_catalog_properties(search_dir, 'failed')
+        created = []
+        mkdtemp = tempfile.mkdtemp
+        with mock.patch('tempfile.mkdtemp', lambda **kw: created.append(mkdtemp(**kw)) or created[-1]), \
+                mock.patch.object(DC.ShardedCatalog, 'merge', side_effect=sqlite3.OperationalError):
+            self.assertRaises(sqlite3.OperationalError, DC.ShardedCatalog(CP17, workers=2).run)
+        self.assertEqual(len(created), 1)
+        self.assertFalse(os.path.exists(created[0]))
+
+    def test_session_diff(self):
+        search_dir = os.path.join(tempfile.mkdtemp(), 'search')
+        shutil.copytree(test_dir, search_dir)
+        CP18 = temporary_catalog_properties(search_dir, 'monday')
+        DC.FileCatalog(CP18)
+
+        os.remove(os.path.join(search_dir, 'text1.txt'))
+        with open(os.path.join(search_dir, 'some_files.xlsx'), 'ab') as f:
+            f.write(b'edit')
+        os.makedirs(os.path.join(search_dir, 'moved'))
+        os.rename(os.path.join(search_dir, 'sub_dir', 'email02-renamed.msg'),
+                  os.path.join(search_dir, 'moved', 'email02-renamed.msg'))
+        with open(os.path.join(search_dir, 'new.txt'), 'w') as f:
+            f.write('hello')
+
+        CP18.session_id = 'friday'
+        with mock.patch('builtins.input', return_value='y'):
+            DC.FileCatalog(CP18)
+
+        database = os.path.join(tempfile.mkdtemp(), '#diff', 'catalog.db')
+        os.makedirs(os.path.dirname(database))
+        shutil.copy(CP18.database, database)
+        diff = DC.SessionDiff(database, 'monday', 'friday')
+        self.assertEqual([r[0] for r in diff.added()], ['new.txt'])
+        self.assertEqual([r[0] for r in diff.removed()], ['text1.txt'])
+        self.assertEqual([r[0] for r in diff.modified()], ['some_files.xlsx'])
+        self.assertEqual([r[:2] for r in diff.moved()],
+                         [(os.path.join('sub_dir', 'email02-renamed.msg'),
+                           os.path.join('moved', 'email02-renamed.msg'))])
+
+        text_size = os.path.getsize(os.path.join(test_dir, 'text1.txt'))
+        msg_size = os.path.getsize(os.path.join(search_dir, 'moved', 'email02-renamed.msg'))
+        deltas = dict((r[0], r[3]) for r in diff.directory_deltas())
+        self.assertEqual(deltas, {'.': 5 + 4 - text_size, 'moved': msg_size, 'sub_dir': -msg_size})
+        self.assertIn('Moved: 1', diff.report())
+        report = diff.report(max_rows=0).splitlines()
+        self.assertIn('Added: 1', report)
+        self.assertNotIn('    new.txt', report)
+        self.assertEqual(report.count('    ...'), 5)
+        diff.close()
+
+    def test_import_time(self):
+        # The scan core must not pull in the heavy optional dependencies
+        code = ('import DocumentCatalog, sys; '
+                'print(sorted(m for m in ("pandas", "xlsxwriter", "numpy", '
+                '"multiprocessing", "zipfile") if m in sys.modules))')
+        result = subprocess.run([sys.executable, '-c', code],
+                                cwd=os.path.dirname(os.path.abspath(DC.__file__)),
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '[]')
+
 if __name__ == '__main__':
     unittest.main()